@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+This file is part of RTL Multi-User Server,
+	that makes multi-user access to your DVB-T dongle used as an SDR.
+
+Delivery jitter of rtl_mus during heavy client churn.
+
+It runs rtl_mus against the fake rtl_tcp of loadtest.py, with a few steady clients measuring the
+end-to-end latency of every chunk, first alone, then while other processes keep connecting and
+disconnecting clients as fast as they can. If connecting or disconnecting clients held up the data
+path, the latency tail (p99, max) of the steady clients would grow with the churn.
+
+Usage: python3 benchmarks/churn.py [--help] [options]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import loadtest  # noqa: E402
+
+
+def churn_process(port, stop_at, connects):
+    # connects, waits for the dongle identifier and the first data, and disconnects, again and again
+    count = 0
+    while time.monotonic() < stop_at:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+            sock.recv(16384)
+            sock.close()
+            count += 1
+        except OSError:
+            pass
+    connects.put(count)
+
+
+def steady_process(port, count, measure_from, stop_at, results):
+    clients = [loadtest.SwarmClient() for i in range(count)]
+
+    async def run_clients():
+        await asyncio.gather(*[client.run(port, b'', measure_from, stop_at) for client in clients])
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run_clients())
+    loop.close()
+    results.put([latency for client in clients for latency in client.latencies])
+
+
+def run(args, churners, config_dir):
+    port, upstream_port, metrics_port = loadtest.free_port(), loadtest.free_port(), loadtest.free_port()
+    commands = multiprocessing.Queue()
+    upstream = multiprocessing.Process(target=loadtest.fake_rtl_tcp, args=(upstream_port, args.rate, commands))
+    upstream.daemon = True
+    upstream.start()
+    with open(os.path.join(config_dir, 'config_churn.py'), 'w') as f:
+        f.write(loadtest.CONFIG_TEMPLATE.format(template=os.path.join(loadtest.ROOT, 'config_rtl_template.py'), port=port, upstream_port=upstream_port,
+                                                rate=args.rate, metrics_port=metrics_port, mode=2, workers=args.workers))
+    server = subprocess.Popen([sys.executable, os.path.join(loadtest.ROOT, 'rtl_mus.py'), 'config_churn'], env=dict(os.environ, PYTHONPATH=config_dir),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        loadtest.wait_for_port(port)
+        measure_from = time.monotonic() + args.warmup
+        stop_at = measure_from + args.duration
+        results, connects = multiprocessing.Queue(), multiprocessing.Queue()
+        steady = multiprocessing.Process(target=steady_process, args=(port, args.steady, measure_from, stop_at, results))
+        steady.start()
+        time.sleep(max(0, measure_from - time.monotonic()))
+        churn = [multiprocessing.Process(target=churn_process, args=(port, stop_at, connects)) for i in range(churners)]
+        for process in churn:
+            process.start()
+        latencies = results.get(timeout=args.duration + 30)
+        connected = sum(connects.get(timeout=30) for process in churn)
+        for process in churn + [steady]:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.terminate()
+    return connected / args.duration, [1000 * loadtest.percentile(latencies, fraction) for fraction in (0.5, 0.99, 0.999, 1.0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delivery jitter of rtl_mus during client churn.')
+    parser.add_argument('--rate', type=int, default=1024000, help='sample rate of the fake rtl_tcp (default: %(default)s)')
+    parser.add_argument('--steady', type=int, default=4, help='steady clients measuring the latency (default: %(default)s)')
+    parser.add_argument('--churn', default='0,1,4', help='comma separated numbers of processes connecting and disconnecting clients (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure for (default: %(default)s)')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to wait before measuring (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0, help='sender_workers of rtl_mus (default: %(default)s)')
+    args = parser.parse_args()
+
+    print("Fake rtl_tcp at %d S/s, %d steady clients, %g s per run" % (args.rate, args.steady, args.duration))
+    print("%6s %11s %38s" % ('churn', 'connects/s', 'latency p50/p99/p99.9/max ms'))
+    config_dir = tempfile.mkdtemp(prefix='rtl_mus_churn')
+    try:
+        for churners in [int(count) for count in args.churn.split(',')]:
+            rate, latency = run(args, churners, config_dir)
+            print("%6d %11.0f %38s" % (churners, rate, '%.2f / %.2f / %.2f / %.2f' % tuple(latency)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(config_dir)
+
+
+if __name__ == "__main__":
+    main()
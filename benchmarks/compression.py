@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+'''
+This file is part of RTL Multi-User Server,
+	that makes multi-user access to your DVB-T dongle used as an SDR.
+
+Benchmark of the frame codecs of the compressed I/Q streams.
+
+For every codec that can be used here it prints the compression ratio, and the CPU
+time needed to encode and to decode 1 MS/s of 8-bit I/Q, in percent of one core.
+It uses a recorded file of raw rtl_sdr / rtl_tcp I/Q if given, synthetic I/Q otherwise
+(noise with a few carriers, at the levels of a typical RTL-SDR).
+
+Usage: python3 benchmarks/compression.py [raw I/Q file] [frame size]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rtl_mus  # noqa: E402
+
+SAMPLES = 4 * 1000 * 1000
+
+
+def synthetic_iq(count):
+    np = rtl_mus.np
+    t = np.arange(count)
+    iq = np.random.normal(0, 6, count) + 1j * np.random.normal(0, 6, count)
+    for frequency, amplitude in ((0.01, 30), (-0.13, 12), (0.27, 5)):
+        iq += amplitude * np.exp(2j * np.pi * frequency * t)
+    data = np.empty(2 * count, dtype=np.uint8)
+    data[0::2] = np.clip(np.rint(iq.real + 127.5), 0, 255)
+    data[1::2] = np.clip(np.rint(iq.imag + 127.5), 0, 255)
+    return data.tobytes()
+
+
+def available_codecs():
+    for name in ('zlib', 'zstd', 'lz4'):
+        for codec in (name, 'delta+' + name):
+            try:
+                rtl_mus.FrameCodec(rtl_mus.frame_codec_id(codec))
+            except AssertionError:
+                continue
+            yield codec
+
+
+def cpu_percent_per_msps(seconds, data):
+    return 100.0 * seconds / (len(data) / 2 / 1e6)
+
+
+def main():
+    frame_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            data = f.read(2 * SAMPLES)
+        data = data[:len(data) & ~1]
+    elif rtl_mus.np is None:
+        sys.exit("Synthetic I/Q requires numpy, give a file of raw I/Q instead.")
+    else:
+        data = synthetic_iq(SAMPLES)
+    frames = [data[i:i + frame_size] for i in range(0, len(data), frame_size)]
+    print("%d samples, frames of %d bytes" % (len(data) // 2, frame_size))
+    print("%-12s %8s %16s %16s" % ('codec', 'ratio', 'encode %/MS/s', 'decode %/MS/s'))
+    for name in available_codecs():
+        codec = rtl_mus.FrameCodec(rtl_mus.frame_codec_id(name))
+        start = time.process_time()
+        encoded = [codec.encode(frame) for frame in frames]
+        encode_time = time.process_time() - start
+        decoder = rtl_mus.FrameDecoder(codec.codec_id)
+        start = time.process_time()
+        decoded = b''.join(decoder.feed(frame) for frame in encoded)
+        decode_time = time.process_time() - start
+        assert decoded == data, name
+        ratio = float(len(data)) / sum(len(frame) for frame in encoded)
+        print("%-12s %8.3f %16.2f %16.2f" % (name, ratio, cpu_percent_per_msps(encode_time, data), cpu_percent_per_msps(decode_time, data)))
+
+
+if __name__ == "__main__":
+    main()
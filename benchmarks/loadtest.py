@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+'''
+This file is part of RTL Multi-User Server,
+	that makes multi-user access to your DVB-T dongle used as an SDR.
+
+Load test of a whole rtl_mus process, against a fake rtl_tcp.
+
+The fake rtl_tcp sends the 12 byte dongle header, then synthetic I/Q at the given sample rate, and
+records the commands it receives. Every chunk it sends starts with a marker holding the time it
+was sent at, so that the clients can measure the end-to-end latency.
+rtl_mus is started with a generated config for every cache_full_behaviour mode and number of clients.
+A swarm of clients connects to it, each sending a command first; most of them read as fast as they
+can, the rest (--slow) read at a fraction of the stream rate, so that rtl_mus has to deal with them.
+For each run it prints:
+  * the sustained throughput of the fast clients, per client and altogether,
+  * the percentiles of the end-to-end latency seen by the fast clients,
+  * the CPU time of rtl_mus (with its sender workers) per client, in percent of one core,
+  * the memory (RSS) of rtl_mus at the end, and how much it has grown during the run,
+  * the drops reported on the metrics endpoint, and the clients rtl_mus has closed,
+  * the commands the fake rtl_tcp has received.
+
+Usage: python3 benchmarks/loadtest.py [--help] [options]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import struct
+import socket
+import shutil
+import argparse
+import threading
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+from urllib.request import urlopen
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MARKER = b'RMUSTIME'  # followed by the time.monotonic() of sending, as a double
+CHUNK_SIZE = 16384
+CONFIG_TEMPLATE = '''exec(open({template!r}).read())
+my_ip = '127.0.0.1'
+my_listening_port = {port}
+rtl_tcp_host = '127.0.0.1'
+rtl_tcp_port = {upstream_port}
+initial_sample_rate = {rate}
+log_file_path = None
+watchdog_interval = 0
+latency_log_interval = 0
+metrics_port = {metrics_port}
+cache_full_behaviour = {mode}
+sender_workers = {workers}
+'''
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def fake_rtl_tcp(port, rate, commands):
+    # sends synthetic I/Q paced at rate samples/sec, and puts every command it receives into commands
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+    noise = bytearray(os.urandom(CHUNK_SIZE))
+    while True:
+        sock, addr = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(b'RTL0' + struct.pack('>II', 5, 29))  # R820T, 29 gain values
+
+        def read_commands(sock=sock):
+            buffer = b''
+            while True:
+                try:
+                    data = sock.recv(4096)
+                except OSError:
+                    data = b''
+                if not data:
+                    return
+                buffer += data
+                while len(buffer) >= 5:
+                    commands.put(buffer[:5])
+                    buffer = buffer[5:]
+        threading.Thread(target=read_commands, daemon=True).start()
+        sent = 0
+        start = time.monotonic()
+        try:
+            while True:
+                noise[:16] = MARKER + struct.pack('d', time.monotonic())
+                sock.sendall(noise)
+                sent += len(noise)
+                ahead = start + sent / (2.0 * rate) - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+        except OSError:
+            sock.close()
+
+
+class SwarmClient(object):
+    '''A client of the load test. A slow client reads only slow_rate bytes/sec, through a small receive buffer.'''
+
+    def __init__(self, slow_rate=0):
+        self.slow_rate = slow_rate
+        self.bytes = 0
+        self.latencies = []
+        self.closed = False
+
+    async def run(self, port, command, measure_from, stop_at):
+        loop = asyncio.get_event_loop()
+        sock = socket.socket()
+        if self.slow_rate:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, ('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(command)
+        tail = b''
+        try:
+            await reader.readexactly(12)
+            while loop.time() < stop_at:
+                data = await asyncio.wait_for(reader.read(65536), max(0.01, stop_at - loop.time()))
+                if not data:
+                    self.closed = True
+                    break
+                now = time.monotonic()
+                if now >= measure_from:
+                    self.bytes += len(data)
+                    self.find_markers(tail + data, now)
+                tail = data[-len(MARKER) - 7:]
+                if self.slow_rate:
+                    await asyncio.sleep(float(len(data)) / self.slow_rate)
+        except asyncio.TimeoutError:
+            pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.closed = True
+        writer.close()
+
+    def find_markers(self, data, now):
+        index = data.find(MARKER)
+        while 0 <= index <= len(data) - len(MARKER) - 8:
+            self.latencies.append(now - struct.unpack_from('d', data, index + len(MARKER))[0])
+            index = data.find(MARKER, index + 1)
+
+
+def swarm_process(port, fast, slow, slow_rate, measure_from, stop_at, results):
+    # one process of the swarm, so that the clients are not limited to one core
+    clients = [SwarmClient() for i in range(fast)] + [SwarmClient(slow_rate) for i in range(slow)]
+    command = struct.pack('>BI', 1, 100000000)  # set the frequency, rtl_mus forwards it to the fake rtl_tcp
+
+    async def run_clients():
+        # time.monotonic() is the clock of the event loop too
+        await asyncio.gather(*[client.run(port, command, measure_from, stop_at) for client in clients])
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run_clients())
+    loop.close()
+    results.put({
+        'fast_bytes': [client.bytes for client in clients[:fast]],
+        'slow_bytes': [client.bytes for client in clients[fast:]],
+        'latencies': [latency for client in clients[:fast] for latency in client.latencies],
+        'closed': sum(client.closed for client in clients),
+    })
+
+
+def process_stats(pid):
+    # CPU seconds and RSS bytes of a process and its children (the sender workers), from /proc
+    pids = [pid] + [int(name) for name in os.listdir('/proc') if name.isdigit() and parent_pid(name) == pid]
+    cpu, rss = 0.0, 0
+    for child in pids:
+        try:
+            with open('/proc/%d/stat' % child) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError):
+            pass  # just exited
+    return cpu, rss
+
+
+def parent_pid(name):
+    try:
+        with open('/proc/%s/stat' % name) as f:
+            return int(f.read().rsplit(')', 1)[1].split()[1])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('rtl_mus did not start listening on port %d' % port)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(args, mode, count, config_dir):
+    port, upstream_port, metrics_port = free_port(), free_port(), free_port()
+    commands = multiprocessing.Queue()
+    upstream = multiprocessing.Process(target=fake_rtl_tcp, args=(upstream_port, args.rate, commands))
+    upstream.daemon = True
+    upstream.start()
+    with open(os.path.join(config_dir, 'config_loadtest.py'), 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(template=os.path.join(ROOT, 'config_rtl_template.py'), port=port, upstream_port=upstream_port,
+                                       rate=args.rate, metrics_port=metrics_port, mode=mode, workers=args.workers))
+    env = dict(os.environ, PYTHONPATH=config_dir)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'rtl_mus.py'), 'config_loadtest'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None)
+    try:
+        wait_for_port(port)
+        slow = int(round(count * args.slow))
+        fast = count - slow
+        processes = min(args.processes, count)
+        measure_from = time.monotonic() + args.warmup
+        stop_at = measure_from + args.duration
+        results = multiprocessing.Queue()
+        swarm = [multiprocessing.Process(target=swarm_process, args=(port, fast * (i + 1) // processes - fast * i // processes, slow * (i + 1) // processes - slow * i // processes,
+                                                                    int(2 * args.rate * args.slow_rate), measure_from, stop_at, results)) for i in range(processes)]
+        for process in swarm:
+            process.start()
+        time.sleep(max(0, measure_from - time.monotonic()))
+        cpu_start, rss_start = process_stats(server.pid)
+        time.sleep(max(0, stop_at - time.monotonic() - 0.2))
+        cpu_end, rss_end = process_stats(server.pid)
+        metrics = json.loads(urlopen('http://127.0.0.1:%d/metrics.json' % metrics_port, timeout=5).read().decode())
+        reports = [results.get(timeout=args.duration + 30) for process in swarm]
+        for process in swarm:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.terminate()
+    received = []
+    while not commands.empty():
+        received.append(commands.get())
+    fast_bytes = [value for report in reports for value in report['fast_bytes']]
+    latencies = [value for report in reports for value in report['latencies']]
+    return {
+        'mode': mode,
+        'clients': count,
+        'slow': slow,
+        'client_rate': sum(fast_bytes) / float(len(fast_bytes) or 1) / args.duration,
+        'total_rate': sum(fast_bytes) / args.duration,
+        'latency': [1000 * percentile(latencies, fraction) for fraction in (0.5, 0.95, 0.99)],
+        'cpu_per_client': 100 * (cpu_end - cpu_start) / args.duration / count,
+        'rss': rss_end,
+        'rss_growth': rss_end - rss_start,
+        'drops': sum(client.get('drops', 0) for client in metrics['clients']),
+        'closed': sum(report['closed'] for report in reports),
+        'commands': len(received),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of rtl_mus against a fake rtl_tcp.')
+    parser.add_argument('--rate', type=int, default=1024000, help='sample rate of the fake rtl_tcp (default: %(default)s)')
+    parser.add_argument('--clients', default='1,10,50', help='comma separated numbers of clients to run with (default: %(default)s)')
+    parser.add_argument('--modes', default='0,1,2,3', help='comma separated cache_full_behaviour modes to run with (default: %(default)s)')
+    parser.add_argument('--slow', type=float, default=0.2, help='fraction of the clients that are slow (default: %(default)s)')
+    parser.add_argument('--slow-rate', type=float, default=0.1, help='slow clients read this fraction of the stream rate (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure for (default: %(default)s)')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to wait before measuring (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0, help='sender_workers of rtl_mus (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=min(4, multiprocessing.cpu_count()), help='processes running the clients (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='show the log of rtl_mus')
+    args = parser.parse_args()
+
+    print("Fake rtl_tcp at %d S/s (%.1f MB/s), %d%% slow clients at %d%% of that, %g s per run" % (
+        args.rate, 2 * args.rate / 1e6, 100 * args.slow, 100 * args.slow_rate, args.duration))
+    print("%4s %7s %5s %11s %11s %25s %11s %9s %9s %6s %6s %8s" % (
+        'mode', 'clients', 'slow', 'MB/s/client', 'MB/s total', 'latency p50/p95/p99 ms', 'CPU%/client', 'RSS MB', 'RSS +MB', 'drops', 'closed', 'commands'))
+    config_dir = tempfile.mkdtemp(prefix='rtl_mus_loadtest')
+    try:
+        for mode in [int(mode) for mode in args.modes.split(',')]:
+            for count in [int(count) for count in args.clients.split(',')]:
+                result = run(args, mode, count, config_dir)
+                print("%4d %7d %5d %11.2f %11.2f %25s %11.2f %9.1f %9.1f %6d %6d %8d" % (
+                    result['mode'], result['clients'], result['slow'], result['client_rate'] / 1e6, result['total_rate'] / 1e6,
+                    '%.1f / %.1f / %.1f' % tuple(result['latency']), result['cpu_per_client'], result['rss'] / 1e6,
+                    result['rss_growth'] / 1e6, result['drops'], result['closed'], result['commands']))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(config_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+'''
+This file is part of RTL Multi-User Server,
+	that makes multi-user access to your DVB-T dongle used as an SDR.
+
+Throughput benchmark of the client send path.
+
+It pushes the same amount of 8-bit I/Q data through a local socket pair twice:
+  * "queue": the previous implementation, one multiprocessing.Queue per client,
+    concatenating the leftover of the last partial send with the next chunk,
+  * "ring": Client.pump, sending memoryviews of the shared RingBuffer with one
+    sendmsg() each time, the transport only holds what the kernel did not take.
+For both it prints bytes/sec and the number of send syscalls per MB.
+
+Usage: python3 benchmarks/send_path.py [megabytes] [receive buffer bytes]
+'''
+
+from __future__ import print_function
+import os
+import sys
+import socket
+import threading
+import time
+import select
+import asyncio
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rtl_mus  # noqa: E402
+
+CHUNK_SIZE = 16348
+
+
+class CountingSocket(socket.socket):
+    '''Socket that counts the send syscalls issued through it.'''
+
+    def __init__(self, *args, **kwargs):
+        socket.socket.__init__(self, *args, **kwargs)
+        self.syscalls = 0
+
+    def send(self, *args):
+        self.syscalls += 1
+        return socket.socket.send(self, *args)
+
+    def sendmsg(self, *args):
+        self.syscalls += 1
+        return socket.socket.sendmsg(self, *args)
+
+
+def socket_pair(receive_buffer):
+    a, b = socket.socketpair()
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sender = CountingSocket(a.family, a.type, a.proto, fileno=a.detach())
+    sender.setblocking(False)
+    return sender, b
+
+
+def wait_writable(sock):
+    # like the event loop: only try to send when the socket can take data
+    select.select([], [sock], [], 0.1)
+
+
+def drain(sock, total, done):
+    received = 0
+    while received < total:
+        data = sock.recv(262144)
+        if not data:
+            break
+        received += len(data)
+    done.append(received)
+
+
+class QueueSender(object):
+    '''The send path as it was before the ring buffer: one pickling queue per client.'''
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.waiting_data = multiprocessing.Queue(250)
+        self.last_waiting_buffer = b''
+
+    def add_data(self, data):
+        if not self.waiting_data.full():
+            self.waiting_data.put(data)
+
+    def writable(self):
+        return not self.waiting_data.empty()
+
+    def handle_write(self):
+        next = self.last_waiting_buffer + self.waiting_data.get()
+        try:
+            sent = self.socket.send(next)
+        except BlockingIOError:
+            sent = 0
+        self.last_waiting_buffer = next[sent:]
+
+
+def run_queue(total, receive_buffer, chunk):
+    sender, receiver = socket_pair(receive_buffer)
+    client = QueueSender(sender)
+    done = []
+    reader = threading.Thread(target=drain, args=(receiver, total, done), daemon=True)
+    reader.start()
+    start = time.time()
+    produced = 0
+    while reader.is_alive():
+        if produced < total and client.waiting_data.qsize() < 200:
+            client.add_data(chunk)
+            produced += len(chunk)
+        elif client.writable() or client.last_waiting_buffer:
+            if client.last_waiting_buffer and not client.writable():
+                client.waiting_data.put(b'')  # flush the tail of the last partial send
+            wait_writable(sender)
+            client.handle_write()
+    elapsed = time.time() - start
+    reader.join()
+    sender.close()
+    receiver.close()
+    return done[0], elapsed, sender.syscalls
+
+
+class CountingClient(rtl_mus.Client):
+    '''Client that counts its sendmsg() calls with the send syscalls of the transport.'''
+
+    def __init__(self, server, counter):
+        rtl_mus.Client.__init__(self, server)
+        self.counter = counter
+
+    def sendmsg(self, buffers):
+        self.counter.syscalls += 1
+        return rtl_mus.Client.sendmsg(self, buffers)
+
+
+class FakeServer(object):
+
+    dongle_identifier = b'RTL0' + b'\x00' * 8
+    streams = {}
+    sample_rate = 250000
+    ring_sample_rate = sample_rate
+
+    def __init__(self):
+        self.config = rtl_mus.CONFIG
+        self.ring = rtl_mus.RingBuffer(rtl_mus.CONFIG.ring_buffer_size)
+        self.latency = rtl_mus.LatencyStats('benchmark')
+
+    def add_client(self, client):
+        client.ident = 0
+
+    def remove_client(self, client):
+        pass
+
+
+def run_ring(total, receive_buffer, chunk):
+    sender, receiver = socket_pair(receive_buffer)
+    loop = rtl_mus.LOOP = asyncio.new_event_loop()
+    server = FakeServer()
+    ring = server.ring
+    done = []
+    reader = threading.Thread(target=drain, args=(receiver, total, done), daemon=True)
+
+    async def produce():
+        transport, client = await loop.connect_accepted_socket(lambda: CountingClient(server, sender), sender)
+        reader.start()
+        while reader.is_alive():
+            # keep roughly the same backlog as the queue variant
+            if ring.head < total and ring.head - client.cursor < 200 * len(chunk):
+                ring.write(chunk)
+                client.pump()
+            else:
+                await asyncio.sleep(0)
+        transport.close()
+
+    start = time.time()
+    loop.run_until_complete(produce())
+    elapsed = time.time() - start
+    reader.join()
+    loop.close()
+    receiver.close()
+    return done[0], elapsed, sender.syscalls
+
+
+class BenchmarkConfig(object):
+    name = 'benchmark'
+    ring_buffer_size = 8 * 1024 * 1024
+    buffer_size = 25000000
+    cache_full_behaviour = 2
+    use_ip_access_control = 0
+    use_uvloop = False
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    receive_buffer = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    rtl_mus.CONFIG = BenchmarkConfig
+    total = megabytes * 1000000
+    chunk = bytes(bytearray(i % 256 for i in range(CHUNK_SIZE)))
+    print("Sending %d MB, receive buffer: %d bytes" % (megabytes, receive_buffer))
+    for name, run in (('queue', run_queue), ('ring', run_ring)):
+        received, elapsed, syscalls = run(total, receive_buffer, chunk)
+        print("%-6s %8.1f MB/s  %8.1f send syscalls/MB" % (name, received / elapsed / 1e6, syscalls / (received / 1e6)))
+
+
+if __name__ == "__main__":
+    main()
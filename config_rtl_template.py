@@ -17,13 +17,33 @@ You should have received a copy of the GNU General Public License
 along with RTL Multi-User Server.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-my_ip=''	# all interfaces
+my_ip=''	# all interfaces, IPv4 and IPv6
 my_listening_port = 7373
 
 #send_first=chr(9)+chr(0)+chr(0)+chr(0)+chr(1) # set direct sampling
 send_first=""
 rtl_tcp_host = 'localhost'
 rtl_tcp_port = 1234
+rtl_tcp_compression = '' # if the upstream is another rtl_mus: ask it for this frame codec (see compression_codecs), and decode it
+relay_mode = False
+'''
+Set relay_mode if the upstream is another rtl_mus (e.g. the one next to the dongle), and this one serves the clients near the users:
+	- the dongle identifier and the last value of each forwarded command are cached, so clients are served at once,
+	  even while the upstream is reconnecting, and the cached settings are sent to the upstream again after reconnecting,
+	- commands that would not change the cached value are not forwarded.
+'''
+relay_state_file = '' # keep the cache of relay_mode in this file, so that it survives restarts
+latency_log_interval = 60 # log how long the newest I/Q data spends inside rtl_mus every N seconds (0: never)
+metrics_port = 0 # serve metrics over HTTP on this port (0: don't): /metrics for Prometheus, /metrics.json for JSON
+metrics_ip = '127.0.0.1' # ...on this interface only, '' for all of them
+profile_timings = False # time every call of the hot paths into histograms, in the metrics (a little overhead, none when off)
+profile_interval = 0.005 # seconds between two samples of the sampling profiler
+profile_path = 'rtl_mus-{pid}.folded' # where the sampling profiler writes the stacks when stopped by SIGUSR1
+'''
+The sampling profiler records the stacks of all the threads, in the folded format of flamegraph.pl, inferno or
+speedscope. Send SIGUSR1 to rtl_mus (or to one of its sender workers) to start it, and again to stop it and write
+profile_path. GET /profile?seconds=N on the metrics port runs it for N seconds and returns the stacks.
+'''
 
 setuid_on_start = 0						# we normally start with root privileges and setuid() to another user
 uid = 999 									# determine by issuing: $ id -u username
@@ -35,7 +55,13 @@ initial_sample_rate = 250000
 
 client_cant_set_until=0		
 first_client_can_set=True	#openwebrx - spectrum thread will set things on start # no good, clients set parameters and things
-buffer_size=25000000	# per client
+buffer_size=25000000	# per client: bytes a client may lag behind the newest data before cache_full_behaviour applies (at most about ring_buffer_size)
+clients_memory_budget=0 # bytes the clients may buffer altogether (0: no limit), see below
+'''
+The I/Q data is stored once for all clients (see ring_buffer_size), a client only has a copy of what is waiting
+for the kernel to take it, which is at most 256 KB. If all clients together have more than clients_memory_budget
+bytes waiting, the slowest ones are downgraded to buffer less, and dropped if they still do not keep up.
+'''
 log_file_path = "/dev/null" # Might be set to /dev/null to turn off logging
 '''
 Allow any host to connect:
@@ -52,17 +78,47 @@ Deny from specific ranges:
 	order_allow_deny=1 # allow and then deny
 	allowed_ip_ranges=() # allow from all
 	denied_ip_ranges=('192.168.0.0/16') # deny any hosts from ...
+
+IPv6 ranges work the same way. Large lists (e.g. blocklists) may be kept in files instead, one range per line,
+in addition to the ones above. The rules are read again on SIGHUP, without a restart:
+	kill -HUP <pid of rtl_mus>
 '''
 use_ip_access_control=0
 order_allow_deny=0
 denied_ip_ranges=() 
 allowed_ip_ranges=()
+denied_ip_ranges_file='' # file of more ranges to deny, one per line, # starts a comment
+allowed_ip_ranges_file='' # file of more ranges to allow
 allow_sample_rate_set = False
 allow_gain_set=1
+command_min_interval=0.05 # seconds between two batches of commands sent to rtl_tcp, pending commands of the same id are coalesced meanwhile
+client_command_rate=10 # commands per second of a client that are sent to rtl_tcp (0: no limit), the ones above wait...
+client_command_burst=5 # ...unless it has sent fewer recently
+allow_channel_set=True # clients may ask for a narrowband channel (server side frequency shift and decimation, requires numpy)
+'''
+Channel commands (on top of the rtl_tcp ones, 1 byte id + 4 byte big endian parameter):
+	0x80 = channel offset from the tuned frequency, in Hz (signed)
+	0x81 = channel sample rate, 0 for the full I/Q stream
+The client then receives 8-bit I/Q samples at about the requested sample rate
+(the input sample rate divided by an integer, at most 256).
+'''
 
+dsp_pipeline=[] # in-process DSP stages to process the raw I/Q data with, before it is sent to the clients
+'''
+Each stage is a tuple of its name and its parameters, e.g.:
+	dsp_pipeline=[('to_complex64',), ('remove_dc',), ('decimate', 4), ('to_uint8',)]
+Stages:
+	('to_complex64',) = convert 8-bit unsigned I/Q to complex64 (requires numpy)
+	('remove_dc', alpha) = remove the DC offset, alpha is the weight of the newest block in its average (default: 0.1)
+	('decimate', factor) = low-pass filter and decimate complex64 I/Q (channels, pre-roll and the recording then go by the decimated rate)
+	('to_uint8',) = convert complex64 I/Q back to 8-bit unsigned I/Q
+	('compress', codec, level) = compress the stream in frames that can each be decoded on their own, codec is one of compression_codecs
+	('decompress', codec) = decode the frames of the compress stage (e.g. of the upstream rtl_mus), from any frame on
+	('command', command) = pipe the stream through an external command
+'''
 use_dsp_command=False # you can process raw I/Q data with a custom command that starts a process that we can pipe the data into, and also pipe out of.
 debug_dsp_command=False # show sample rate before and after the dsp command
-dsp_command=""
+dsp_command="" # when used, it runs as the last stage of dsp_pipeline
 
 '''
 Example DSP commands:
@@ -74,9 +130,11 @@ Example DSP commands:
 watchdog_interval=1.5
 reconnect_interval=10 
 '''
-If there's no input I/Q data after N seconds, input will be filled with zero samples, 
-so that GNU Radio won't fail in openwebrx. It may reconnect rtl_tcp_tread. 
-If watchdog_interval is 0, then watchdog thread is not started. 
+If there's no input I/Q data after watchdog_interval seconds, the connection to rtl_tcp is dropped and 
+reopened, and input will be filled with zero samples at the current sample rate until the data is back, 
+so that GNU Radio won't fail in openwebrx. If watchdog_interval is 0, then the watchdog is not started. 
+After the connection to rtl_tcp is lost, the first attempt to reconnect is made after about 0.1 s, and 
+every next one waits twice as long, up to reconnect_interval seconds.
 
 '''
 cache_full_behaviour=2
@@ -84,5 +142,76 @@ cache_full_behaviour=2
 	0 = drop samples
 	1 = close client
 	2 = openwebrx: don't care about that client until it wants samples again (gr-osmosdr bug workaround)
+	3 = skip ahead to the newest samples (keeping skip_ahead_margin seconds of them), logged once per lag episode
+'''
+skip_ahead_margin=0.1 # seconds
+use_uvloop=False # use the uvloop event loop instead of the default asyncio one (requires the uvloop package)
+ring_buffer_size=8*1024*1024
+'''
+The I/Q stream is stored once in a shared ring buffer of this many bytes, and each client only keeps a read position in it.
+A client is considered slow (and cache_full_behaviour applies) when it lags behind the newest data by almost this amount.
+'''
+sender_workers=0
+'''
+Number of worker processes that send the I/Q data to the clients (Linux only).
+With 0 everything runs in a single process. With N > 0 the main process keeps the rtl_tcp connection and
+accepts the clients, then hands each one over to the least loaded worker, which reads the I/Q data from a
+shared memory ring. Set it to about the number of CPU cores to serve more clients.
+'''
+compression_codecs=()
+'''
+Frame codecs of the compressed I/Q streams clients may ask for, e.g. ('zstd', 'delta+zstd').
+Codecs: 'zlib', 'zstd' (requires zstandard), 'lz4' (requires lz4), and the same with 'delta+' in front
+(the I and Q bytes are delta coded before compression, requires numpy).
+Each codec listed here compresses the whole I/Q stream once, for all the clients that use it, and only while it has any.
+A client switches to a compressed stream with command 0x82, its parameter being the codec id:
+	1 = zlib, 2 = zstd, 3 = lz4, plus 128 for delta coding, 0 = back to plain I/Q
+'''
+compression_frame_size=65536 # bytes of I/Q data compressed together, more compresses better, but adds latency
+compressed_listening_port=0 # clients connecting to this port get the compressed stream right away (0: don't listen)
+compressed_listening_codec='zstd'
+preroll_seconds=0
+'''
+Clients may start with up to this many seconds of the past I/Q data, e.g. for an instant waterfall, or to catch
+a transmission that began just before they connected. The ring buffer (ring_buffer_size) is made large enough to
+hold this much at initial_sample_rate, and it is shared by all the clients.
+A client goes back in time with command 0x83, its parameter being the milliseconds to go back from the newest data,
+sent right after connecting (it is denied once the client has got I/Q data).
+'''
+preroll_listening_port=0 # clients connecting to this port start preroll_seconds in the past right away (0: don't listen)
+upstreams=[]
+'''
+To serve several dongles from one process, list one dict per upstream rtl_tcp here. Each may set any option of this
+file (and a name, for the logs and the metrics), the ones it does not set are taken from above. They share one event
+loop, the metrics and clients_memory_budget, so the options of the whole process cannot be set per upstream: logging,
+setuid, IP access control, metrics, clients_memory_budget, latency_log_interval, use_uvloop and profiling. For example:
+	upstreams=[
+		dict(name='dongle0', rtl_tcp_port=1234, my_listening_port=7373),
+		dict(name='dongle1', rtl_tcp_port=1235, my_listening_port=7374, initial_sample_rate=2048000),
+	]
+Clients may switch to another upstream with command 0x84, its parameter being the index of the upstream in this list
+(not for upstreams with sender_workers). If this list is empty, the options above make the only upstream.
+'''
+multicast_group='' # also publish the I/Q stream to this multicast group, e.g. '239.73.73.1' ('': don't)
+multicast_port=7375
+multicast_ttl=1 # 1: the LAN only
+multicast_interface='' # IP address of the interface to send (and receive) multicast on ('': the default one)
+multicast_mtu=1500 # datagrams are made to fit in this
+multicast_upstream='' # 'group:port': receive the stream from the multicast of another rtl_mus, instead of connecting to rtl_tcp
+'''
+With multicast_group set, the stream is sent once to the LAN, however many machines use it. On each of those,
+an rtl_mus with multicast_upstream set (e.g. '239.73.73.1:7375') turns it back into an rtl_tcp stream for its
+local clients, with null samples in place of lost datagrams. The multicast is one-way: commands of the clients
+of the receiving rtl_mus are not sent to the dongle.
+'''
+record_path='' # record the I/Q stream into segment files in this directory ('': don't)
+record_segment_size=1024*1024*1024 # bytes per segment file, preallocated
+record_segments=0 # keep only the newest this many segment files (0: keep all)
+record_index_interval=1.0 # seconds between two lines of the index of a segment
+replay_file='' # serve a recorded segment (.iq) to the clients, in a loop, instead of connecting to rtl_tcp
+'''
+The recording never holds up the clients: it reads the ring in a thread of its own, and if the disk is too slow,
+it skips data and counts drops (see the metrics). Each segment <upstream name>-<start time>-<number>.iq is raw
+8-bit I/Q like the output of rtl_sdr, and its <...>.idx has one JSON line per record_index_interval seconds
+with the time (Unix time) of the byte at offset, and the sample_rate, so that a time can be found in the recording.
 '''
-
@@ -1,4 +1,4 @@
-#!/usr/bin/python2
+#!/usr/bin/python3
 '''
 This file is part of RTL Multi-User Server,
 	that makes multi-user access to your DVB-T dongle used as an SDR.
@@ -21,11 +21,13 @@ along with RTL Multi-User Server.  If not, see <http://www.gnu.org/licenses/>.
 
 2013-11?  Asyncore version
 #2014-03   Fill with null on no data
+2026-10   asyncio version
 
 '''
 
 from __future__ import print_function, unicode_literals
 import socket
+import errno
 import sys
 import struct
 import time
@@ -34,17 +36,62 @@ import os
 import time
 import ipaddress
 import subprocess
+import shlex
+import json
+import types
+import bisect
+import signal
+import functools
+import threading
+import urllib.parse
+import zlib
+import mmap
+import re
 try:
     import thread
 except ImportError:
     import _thread as thread
-import asyncore
+import asyncio
+import collections
+import random
 import multiprocessing
+import queue
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
 import traceback
 
 LOGGER = logging.getLogger("rtl_mus")
 
+# Commands of our own, on top of the ones of rtl_tcp. They configure the connection
+# of the client that sent them, and are never forwarded to rtl_tcp.
+SET_CHANNEL_OFFSET = 0x80  # param: signed offset of the channel center from the tuned frequency, in Hz
+SET_CHANNEL_RATE = 0x81  # param: output sample rate of the channel, 0 for the full I/Q stream
+SET_COMPRESSION = 0x82  # param: id of the frame codec to receive the I/Q stream with, 0 for plain I/Q
+SET_PREROLL = 0x83  # param: milliseconds to go back in time from the newest data, at most preroll_seconds
+SET_UPSTREAM = 0x84  # param: index of the upstream in upstreams to switch to
+CLIENT_COMMANDS = (SET_CHANNEL_OFFSET, SET_CHANNEL_RATE, SET_COMPRESSION, SET_PREROLL, SET_UPSTREAM)
+
+COMMAND_NAMES = {
+    1: 'frequency', 2: 'sample_rate', 3: 'gain_mode', 4: 'gain', 5: 'freq_correction', 6: 'if_gain', 7: 'test_mode',
+    8: 'agc_mode', 9: 'direct_sampling', 10: 'offset_tuning', 11: 'rtl_xtal', 12: 'tuner_xtal', 13: 'gain_by_index',
+}
+TUNER_TYPES = {0: 'unknown', 1: 'E4000', 2: 'FC0012', 3: 'FC0013', 4: 'FC2580', 5: 'R820T', 6: 'R828D'}
+
 
 def setup_logging():
     LOGGER.setLevel(logging.DEBUG)
@@ -76,132 +123,717 @@ def convert_short_ip_to_subnet(ip_range):
 
 def ip_network(ip_range):
     try:
-        return ipaddress.ip_network(ip_range)
+        return ipaddress.ip_network(ip_range, strict=False)
     except ValueError:
         return ipaddress.ip_network(convert_short_ip_to_subnet(ip_range))
 
 
-def ip_match(this, ip_ranges):
-    return any(ipaddress.ip_address(this) in network for network in ip_ranges)
+def ip_address(ip):
+    # (version, address as an integer), IPv4-mapped IPv6 addresses (of dual-stack sockets) as IPv4
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        address = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.split('%')[0]), 'big')
+        if address >> 32 == 0xffff:
+            return 4, address & 0xffffffff
+        return 6, address
+
+
+class IpRanges(object):
+    '''
+    IPv4 and IPv6 networks compiled into sorted, disjoint intervals of addresses, so that looking up
+    an address is a binary search, however many thousands of networks there are.
+    '''
+
+    def __init__(self, networks):
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+        for network in sorted(networks, key=lambda network: (network.version, int(network.network_address))):
+            starts, ends = self.starts[network.version], self.ends[network.version]
+            start, end = int(network.network_address), int(network.broadcast_address)
+            if ends and start <= ends[-1] + 1:  # overlapping or adjacent
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    def __contains__(self, address):
+        version, address = address
+        index = bisect.bisect_right(self.starts[version], address) - 1
+        return index >= 0 and address <= self.ends[version][index]
+
+    def __len__(self):
+        return len(self.starts[4]) + len(self.starts[6])
+
+
+def load_ip_ranges(config, option):
+    # the ranges of the option, and the ones in the file of option_file (one per line, # comments), all addresses if none
+    ip_ranges = getattr(config, option)
+    assert isinstance(ip_ranges, tuple), 'Make sure %s is a tuple' % option
+    path = getattr(config, option + '_file', '')
+    if path:
+        with open(path) as f:
+            ip_ranges += tuple(line.split('#')[0].strip() for line in f if line.split('#')[0].strip())
+    return IpRanges(ip_network(ip_range) for ip_range in ip_ranges or ('0.0.0.0/0', '::/0'))
+
+
+class IpAccessControl(object):
+    '''
+    The IP access rules of the configuration, compiled. The decisions on the addresses seen recently are
+    cached, which helps when the same clients keep reconnecting. Reloading the rules makes a new one.
+    '''
+
+    cache_size = 4096
+
+    def __init__(self, config):
+        self.enabled = config.use_ip_access_control
+        self.order_allow_deny = config.order_allow_deny
+        self.allowed = load_ip_ranges(config, 'allowed_ip_ranges')
+        self.denied = load_ip_ranges(config, 'denied_ip_ranges')
+        self.decide = functools.lru_cache(self.cache_size)(self.decide)  # the cache goes with these rules
+
+    def decide(self, ip):
+        address = ip_address(ip)
+        if self.order_allow_deny:
+            return address not in self.denied and address in self.allowed
+        else:
+            return address in self.allowed or address not in self.denied
+
+
+IP_ACCESS = None  # IpAccessControl, None: allow all (in the sender workers, the main process has checked the clients)
 
 
 def ip_access_control(ip):
-    if not CONFIG.use_ip_access_control:
-        return True
-    allowed = ip_match(ip, CONFIG.allowed_ip_ranges)
-    denied = ip_match(ip, CONFIG.denied_ip_ranges)
-    if CONFIG.order_allow_deny:
-        return False if denied else allowed
-    else:
-        return True if allowed else not denied
+    return IP_ACCESS is None or not IP_ACCESS.enabled or IP_ACCESS.decide(ip)
 
 
-def dsp_read_thread(fid):
-    global dsp_data_count
-    dsp_data_count = 0
-    while True:
-        try:
-            my_buffer = fid.read(1024)
-        except IOError:
-            LOGGER.error("DSP subprocess is not ready for reading.")
-            time.sleep(1)
-            continue
-        SERVER.add_data_to_clients(my_buffer)
-        if CONFIG.debug_dsp_command:
-            dsp_data_count += len(my_buffer)
-
-
-def dsp_write_thread(fid, dsp_input_queue):
-    global original_data_count
-    original_data_count = 0
-    while True:
-        try:
-            my_buffer = dsp_input_queue.get(timeout=0.3)
-        except Exception:
-            continue
-        try:
-            fid.write(my_buffer)
-        except IOError:
-            break
-        fid.flush()
-        if CONFIG.debug_dsp_command:
-            original_data_count += len(my_buffer)
+def reload_ip_access_control():
+    # on SIGHUP: the IP access control options are read from the configuration script again, and the files of ranges
+    global IP_ACCESS
+    try:
+        config = types.ModuleType(CONFIG.__name__)
+        config.__file__ = CONFIG.__file__
+        with open(CONFIG.__file__) as f:
+            exec(compile(f.read(), CONFIG.__file__, 'exec'), config.__dict__)
+        IP_ACCESS = IpAccessControl(config)
+    except Exception as exc:
+        LOGGER.error("cannot reload the IP access control, keeping the old rules: %s", exc)
+        return
+    LOGGER.info("IP access control reloaded: %s, %d allowed and %d denied ranges", 'on' if IP_ACCESS.enabled else 'off', len(IP_ACCESS.allowed), len(IP_ACCESS.denied))
+
+
+# Compressed I/Q streams are sent in frames, each compressed on its own, so that a client can start
+# with any of them: magic, codec id, length of the I/Q data, length of the payload, payload
+FRAME_MAGIC = b'RMZ1'
+FRAME_HEADER = struct.Struct('>4sBII')
+FRAME_CODECS = {'zlib': 1, 'zstd': 2, 'lz4': 3}
+DELTA_CODEC = 0x80  # added to the codec id: the I and Q bytes are delta coded before compression
+STORED_CODEC = 0  # codec id of frames that would not get smaller
+
+
+def frame_codec_id(name):
+    delta = name.startswith('delta+')
+    return FRAME_CODECS[name[6:] if delta else name] | (DELTA_CODEC if delta else 0)
+
+
+class FrameCodec(object):
+    '''Compresses and decompresses the frames of one codec, e.g. "zstd" or "delta+zstd".'''
+
+    def __init__(self, codec_id, level=1):
+        self.codec_id = codec_id
+        self.delta = bool(codec_id & DELTA_CODEC)
+        base = codec_id & ~DELTA_CODEC
+        assert not self.delta or np is not None, 'delta coded frames require numpy'
+        if base == FRAME_CODECS['zlib']:
+            self.compress = lambda data: zlib.compress(data, level)
+            self.decompress = lambda data, length: zlib.decompress(data)
+        elif base == FRAME_CODECS['zstd']:
+            assert zstandard is not None, 'zstd frames require the zstandard package'
+            compressor, decompressor = zstandard.ZstdCompressor(level=level), zstandard.ZstdDecompressor()
+            self.compress = compressor.compress
+            self.decompress = lambda data, length: decompressor.decompress(data, max_output_size=length)
+        elif base == FRAME_CODECS['lz4']:
+            assert lz4 is not None, 'lz4 frames require the lz4 package'
+            self.compress = lambda data: lz4.block.compress(data, store_size=False)
+            self.decompress = lambda data, length: lz4.block.decompress(data, uncompressed_size=length)
+        else:
+            raise ValueError('unknown frame codec: %d' % codec_id)
+
+    def encode(self, data):
+        payload = self.compress(delta_encode(data) if self.delta else data)
+        if len(payload) >= len(data):
+            return FRAME_HEADER.pack(FRAME_MAGIC, STORED_CODEC, len(data), len(data)) + data
+        return FRAME_HEADER.pack(FRAME_MAGIC, self.codec_id, len(data), len(payload)) + payload
+
+    def decode(self, codec_id, payload, length):
+        if codec_id == STORED_CODEC:
+            return payload
+        data = self.decompress(payload, length)
+        return delta_decode(data) if self.delta else data
+
+
+def delta_encode(data):
+    # I and Q bytes as the difference from the previous I and Q byte (mod 256)
+    samples = np.frombuffer(data, dtype=np.uint8)
+    output = samples.copy()
+    output[2:] -= samples[:-2]
+    return output.tobytes()
+
+
+def delta_decode(data):
+    return np.cumsum(np.frombuffer(data, dtype=np.uint8).reshape(-1, 2), axis=0, dtype=np.uint8).tobytes()
+
+
+class FrameDecoder(object):
+    '''
+    Decodes a compressed stream received from another rtl_mus. Anything before the first frame
+    is skipped (plain I/Q that was on its way when we asked for compression). If more than
+    max_skipped bytes come without a frame, the upstream is not sending frames at all.
+    '''
+
+    max_frame = 16 * 1024 * 1024
+    max_skipped = 4 * 1024 * 1024
+
+    def __init__(self, codec_id):
+        self.codec = FrameCodec(codec_id)
+        self.buffer = bytearray()
+        self.synced = False
+        self.skipped = 0  # bytes skipped since the last frame decoded
+
+    def feed(self, data):
+        self.buffer += data
+        output = []
+        while True:
+            if not self.synced:
+                start = self.buffer.find(FRAME_MAGIC)
+                if start < 0:
+                    skipped = max(0, len(self.buffer) - len(FRAME_MAGIC) + 1)
+                    self.skipped += skipped
+                    del self.buffer[:skipped]
+                    break
+                self.skipped += start
+                del self.buffer[:start]
+                self.synced = True
+            if len(self.buffer) < FRAME_HEADER.size:
+                break
+            magic, codec_id, length, payload_length = FRAME_HEADER.unpack_from(self.buffer)
+            if magic != FRAME_MAGIC or codec_id not in (self.codec.codec_id, STORED_CODEC) or max(length, payload_length) > self.max_frame:
+                LOGGER.error("compressed stream: invalid frame header, looking for the next frame")
+                self.resync()
+                continue
+            end = FRAME_HEADER.size + payload_length
+            if len(self.buffer) < end:
+                break
+            try:
+                output.append(self.codec.decode(codec_id, bytes(self.buffer[FRAME_HEADER.size:end]), length))
+            except Exception as exc:
+                LOGGER.error("compressed stream: cannot decode frame: %s", exc)
+                self.resync()
+                continue
+            del self.buffer[:end]
+            self.skipped = 0
+        return b''.join(output)
+
+    def resync(self):
+        del self.buffer[:1]
+        self.skipped += 1
+        self.synced = False
+
+
+class CompressedStream(object):
+    '''
+    The I/Q stream in frames of one codec, for the clients that asked for it. The data is batched
+    into frames of compression_frame_size bytes, and each frame is compressed once for all of
+    those clients, into a ring of its own (so that a frame always starts at a chunk boundary).
+    A stream is only encoded while it has subscribers: clients of its codec, of any sender worker.
+    '''
+
+    def __init__(self, config, name, shared):
+        self.name = name
+        self.codec = FrameCodec(frame_codec_id(name))
+        self.config = config
+        # a frame is written at once, so that the head is always at a frame boundary
+        self.ring = RingBuffer(config.ring_buffer_size, shared, config.compression_frame_size + FRAME_HEADER.size)
+        self.pending = bytearray()
+        self.subscribers = 0
+        self.position = 0  # bytes of the I/Q stream so far, encoded or not
+        self.resuming = False
+
+    def subscribe(self):
+        if not self.subscribers:
+            # the first frame after a pause starts with the next data, and with an I sample
+            del self.pending[:]
+            self.resuming = True
+        self.subscribers += 1
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+
+    def write(self, data):
+        position = self.position
+        self.position += len(data)
+        if not self.subscribers:
+            return
+        if self.resuming:
+            self.resuming = False
+            data = data[position & 1:]
+        self.pending += data
+        size = self.config.compression_frame_size
+        while len(self.pending) >= size:
+            self.ring.write(self.codec.encode(bytes(self.pending[:size])))
+            del self.pending[:size]
+
+
+class RingBuffer(object):
+    '''
+    Preallocated byte ring that holds the I/Q stream once for all clients.
+    Positions are absolute byte offsets since the start of the stream, so a reader
+    only needs an integer cursor, and its lag is simply head - cursor.
+    '''
+
+    max_write = 256 * 1024  # the most the producer writes before it publishes the head (a whole data_received)
+    max_read = 256 * 1024  # the most a reader copies at once (Client.max_send)
+    safety_margin = max_write + max_read  # keep readers away from the region the producer is about to overwrite
+
+    def __init__(self, size, shared=False, max_write=None):
+        if max_write is not None:
+            self.max_write = max_write
+            self.safety_margin = max_write + self.max_read
+        assert size > 2 * self.safety_margin, 'ring_buffer_size is too small'
+        self.size = size
+        # The first 16 bytes hold the head and the time of the last write. A shared ring lives in an anonymous
+        # shared mapping, so that the sender worker processes forked later see the data, the head and the time.
+        self.buffer = mmap.mmap(-1, 16 + size) if shared else bytearray(16 + size)
+        view = memoryview(self.buffer)
+        self.head_view = view[:8].cast('Q')
+        self.time_view = view[8:16].cast('d')
+        self.view = view[16:]
+        self.max_lag = size - self.safety_margin
+        # In a sender worker: the head as the main process last published it over the notify pipe. The data under it
+        # is in place even on weakly ordered CPUs (e.g. ARM), which the head in the shared mapping does not guarantee.
+        self.reader_head = None
+
+    @property
+    def head(self):
+        return self.head_view[0] if self.reader_head is None else self.reader_head
+
+    @property
+    def write_time(self):
+        return self.time_view[0]
+
+    def write(self, data):
+        # in pieces of at most max_write bytes, each published before the next one overwrites anything
+        data = memoryview(data)
+        for offset in range(0, len(data), self.max_write):
+            self.write_piece(data[offset:offset + self.max_write])
+
+    def write_piece(self, data):
+        length = len(data)
+        head = self.head_view[0]
+        start = head % self.size
+        first = min(length, self.size - start)
+        self.view[start:start + first] = data[:first]
+        if first < length:
+            self.view[:length - first] = data[first:]
+        self.time_view[0] = time.monotonic()
+        self.head_view[0] = head + length  # published only after the data is in place
+
+    def intact(self, cursor):
+        # Whether the data from cursor on is still there, to be checked after copying it (like a seqlock): a sender
+        # worker reads while the main process writes, which may be writing a piece not published yet.
+        return self.head_view[0] - cursor <= self.size - self.max_write
+
+    def read(self, cursor, max_length=None):
+        # returns the data between cursor and head as at most two memoryviews (two if it wraps around)
+        length = self.head - cursor
+        if max_length is not None:
+            length = min(length, max_length)
+        if length <= 0:
+            return []
+        start = cursor % self.size
+        first = min(length, self.size - start)
+        if first == length:
+            return [self.view[start:start + length]]
+        return [self.view[start:], self.view[:length - first]]
+
+
+def lowpass_taps(cutoff, ntaps):
+    # windowed sinc low-pass filter, cutoff is given as a fraction of the sample rate
+    n = np.arange(ntaps) - (ntaps - 1) / 2.0
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(ntaps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+def iq_from_uint8(data):
+    # 8-bit unsigned I/Q (as rtl_tcp sends it) to complex64, centered on 0
+    samples = np.frombuffer(data, dtype=np.uint8).astype(np.float32)
+    samples -= 127.5
+    return samples.view(np.complex64)
+
+
+def iq_to_uint8(iq):
+    # complex64 to 8-bit unsigned I/Q, modifies iq
+    samples = iq.view(np.float32)
+    samples += 127.5
+    np.rint(samples, out=samples)
+    np.clip(samples, 0, 255, out=samples)
+    return samples.astype(np.uint8)
+
+
+class Decimator(object):
+    '''
+    Low-pass FIR filter followed by decimation. Only every decimation-th output
+    of the filter is computed (polyphase decimation).
+    '''
+
+    taps_per_phase = 16
+    passband = 0.8  # part of the output bandwidth kept by the filter
+    max_decimation = 256  # of a channel: bounds its taps, its history and the time to compute them
+
+    def __init__(self, decimation):
+        self.decimation = decimation
+        ntaps = decimation * self.taps_per_phase + 1
+        self.taps = lowpass_taps(0.5 * self.passband / decimation, ntaps)[::-1].copy()
+        self.history = np.zeros(ntaps - 1, dtype=np.complex64)
+        self.skip = 0  # index of the next input sample that produces an output, carried between blocks
+
+    def process(self, iq):
+        signal = np.concatenate((self.history, iq))
+        self.history = signal[len(signal) - len(self.history):]
+        windows = np.lib.stride_tricks.sliding_window_view(signal, len(self.taps))[self.skip::self.decimation]
+        self.skip = (self.skip - len(iq)) % self.decimation
+        return (windows @ self.taps).astype(np.complex64)
+
+
+class Channelizer(object):
+    '''
+    Narrowband channel of one client: shifts the channel center to 0 Hz, low-pass filters
+    and decimates the stream, and quantizes it back to 8-bit unsigned I/Q, like rtl_tcp sends it.
+    '''
+
+    def __init__(self, input_rate, offset, output_rate):
+        self.input_rate = input_rate
+        self.decimator = Decimator(max(1, min(Decimator.max_decimation, int(round(float(input_rate) / output_rate)))))
+        self.output_rate = input_rate // self.decimator.decimation
+        self.phase_increment = -2 * np.pi * offset / input_rate
+        self.phase = 0.0
+
+    def process(self, data):
+        # data is 8-bit I/Q of an even length, returns the 8-bit I/Q of the channel
+        iq = iq_from_uint8(data)
+        count = len(iq)
+        phases = np.arange(count, dtype=np.float64)
+        phases *= self.phase_increment
+        phases += self.phase
+        iq *= np.exp(1j * phases).astype(np.complex64)
+        self.phase = (self.phase + self.phase_increment * count) % (2 * np.pi)
+        return iq_to_uint8(self.decimator.process(iq)).tobytes()
+
+
+class DspStage(object):
+    '''
+    One step of the in-process DSP pipeline. process() gets the output of the previous stage
+    (8-bit I/Q bytes, or a complex64 array after to_complex64), and returns its own output,
+    or None if it has nothing to pass on right now.
+    '''
+
+    decimation = 1  # its output sample rate is the input one divided by this
+
+    def start(self, pipeline, index):
+        pass
 
+    def reset(self):
+        # the upstream has connected again, what it sends does not continue the earlier data
+        pass
 
-def dsp_debug_thread():
-    global dsp_data_count, original_data_count
-    while True:
-        dsp_data_count = original_data_count = 0
-        time.sleep(1)
-        LOGGER.debug("DSP | Original data: %dkB/sec | Processed data: %dkB/sec", original_data_count / 1000, dsp_data_count / 1000)
+    def process(self, data):
+        return data
 
 
-def start_dsp(dsp_input_queue):
-    LOGGER.info("Opening DSP process...")
-    proc = subprocess.Popen(CONFIG.dsp_command.split(" "), stdin=subprocess.PIPE, stdout=subprocess.PIPE)  # !! should fix the split :-S
-    dsp_read_thread_v = thread.start_new_thread(dsp_read_thread, (proc.stdout,))
-    dsp_write_thread_v = thread.start_new_thread(dsp_write_thread, (proc.stdin, dsp_input_queue))
-    if CONFIG.debug_dsp_command:
-        dsp_debug_thread_v = thread.start_new_thread(dsp_debug_thread, ())
+class ToComplex64Stage(DspStage):
 
+    def __init__(self):
+        assert np is not None, 'the to_complex64 DSP stage requires numpy'
 
-class Client(asyncore.dispatcher):
+    def process(self, data):
+        return iq_from_uint8(data)
 
-    def __init__(self, socket, addr, port, identifier):
-        self.ident = identifier
-        self.waiting_data = multiprocessing.Queue(250)
-        self.start_time = time.time()
-        self.address = addr
-        self.port = port
-        self.sent_dongle_id = False
-        self.last_waiting_buffer = b""
-        asyncore.dispatcher.__init__(self, socket)
 
-    def handle_read(self):
-        command = bytearray(self.recv(5))
-        if len(command) >= 5:
-            if self.command_allowed(command):
-                RTL_TCP.commands.put(command)
+class RemoveDcStage(DspStage):
+    '''Subtracts the DC offset of the tuner, tracked with an exponential average of the block means.'''
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.dc = None
+
+    def process(self, iq):
+        mean = iq.mean()
+        self.dc = mean if self.dc is None else self.dc + self.alpha * (mean - self.dc)
+        iq -= self.dc
+        return iq
+
+
+class DecimateStage(DspStage):
+
+    def __init__(self, factor):
+        self.decimator = Decimator(factor)
+        self.decimation = factor
+
+    def process(self, iq):
+        return self.decimator.process(iq)
+
+
+class ToUint8Stage(DspStage):
+
+    def process(self, iq):
+        return iq_to_uint8(iq)
+
+
+class CompressStage(DspStage):
+    '''
+    Compresses every block into a frame of its own (see FrameCodec), so that the stream can be decoded
+    from any frame on: by a client that connects later, or after it has skipped data.
+    '''
+
+    def __init__(self, codec='zstd', level=3):
+        self.codec = FrameCodec(frame_codec_id(codec), level)
+
+    def process(self, data):
+        return self.codec.encode(bytes(data))
+
+
+class DecompressStage(DspStage):
+    '''Decodes the frames of the compress stage, from the first whole frame it gets on.'''
+
+    def __init__(self, codec='zstd'):
+        self.codec_id = frame_codec_id(codec)
+        self.decoder = FrameDecoder(self.codec_id)
+
+    def reset(self):
+        self.decoder = FrameDecoder(self.codec_id)  # a partial frame of the earlier connection would never end
+
+    def process(self, data):
+        return self.decoder.feed(data)
+
+
+class CommandStage(DspStage):
+    '''
+    Pipes the stream through an external command (this is what dsp_command does).
+    The following stages get its output in the thread that reads it.
+    '''
+
+    def __init__(self, command):
+        self.command = command
+        self.input = queue.Queue()
+
+    def start(self, pipeline, index):
+        LOGGER.info("Opening DSP process...")
+        # unbuffered pipes: every block is written with one syscall and needs no flush
+        self.proc = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        thread.start_new_thread(self.write_thread, ())
+        thread.start_new_thread(self.read_thread, (pipeline, index + 1))
+
+    def process(self, data):
+        self.input.put(data)  # the writer thread waits for the pipe, not the event loop
+        return None
+
+    def write_thread(self):
+        while True:
+            data = self.input.get()
+            try:
+                self.write_block(data)
+            except IOError:
+                LOGGER.error("DSP subprocess is not accepting data anymore.")
+                break
+
+    def write_block(self, data):
+        self.proc.stdin.write(data)
+
+    def read_thread(self, pipeline, next_stage):
+        while True:
+            data = self.proc.stdout.read(65536)
+            if not data:
+                LOGGER.error("DSP subprocess has exited.")
+                break
+            self.forward_block(pipeline, next_stage, data)
+
+    def forward_block(self, pipeline, next_stage, data):
+        pipeline.feed(data, next_stage)
+
+
+DSP_STAGES = {
+    'to_complex64': ToComplex64Stage,
+    'remove_dc': RemoveDcStage,
+    'decimate': DecimateStage,
+    'to_uint8': ToUint8Stage,
+    'compress': CompressStage,
+    'decompress': DecompressStage,
+    'command': CommandStage,
+}
+
+
+class DspPipeline(object):
+    '''Runs the I/Q stream through the DSP stages, then hands it over to sink.'''
+
+    def __init__(self, stages, sink):
+        self.stages = stages
+        self.sink = sink
+        self.decimation = 1  # the output sample rate is the input one divided by this
+        for stage in stages:
+            self.decimation *= stage.decimation
+        # totals since the start, each written by one thread only
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.errors = 0
+        for index, stage in enumerate(stages):
+            stage.start(self, index)
+
+    def feed(self, data, start=0):
+        if not start:
+            self.input_bytes += len(data)
+        for stage in self.stages[start:]:
+            try:
+                data = stage.process(data)
+            except Exception as exc:  # e.g. data it cannot decode: the block is lost, not the upstream connection
+                self.errors += 1
+                LOGGER.error("DSP stage %s: %s", type(stage).__name__, exc)
+                return
+            if data is None or not len(data):
+                return
+        data = memoryview(data).cast('B')
+        self.output_bytes += len(data)
+        self.sink(data)
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+
+def dsp_debug_thread(pipeline):
+    while True:
+        input_bytes, output_bytes = pipeline.input_bytes, pipeline.output_bytes
+        time.sleep(1)
+        LOGGER.debug("DSP | Original data: %dkB/sec | Processed data: %dkB/sec", (pipeline.input_bytes - input_bytes) / 1000, (pipeline.output_bytes - output_bytes) / 1000)
+
+
+def start_dsp(server):
+    config = server.config
+    stages = [DSP_STAGES[spec[0]](*spec[1:]) for spec in config.dsp_pipeline]
+    if config.use_dsp_command:
+        stages.append(CommandStage(config.dsp_command))
+    pipeline = DspPipeline(stages, server.add_data)
+    if config.debug_dsp_command:
+        thread.start_new_thread(dsp_debug_thread, (pipeline,))
+    return pipeline
+
+
+class Client(asyncio.Protocol):
+
+    max_send = RingBuffer.max_read  # upper bound of bytes sent at once
+    write_buffer_high = max_send  # the most the transport buffers for a client: what the kernel did not take of one send
+    min_write_buffer_high = 32 * 1024  # downgrade() does not go below this
+    lag_episode_gap = 5.0  # a lag episode is over when a client has not fallen behind for this many seconds
+    lag_log_interval = 60.0  # cache_full_behaviour 3 logs the start of a lag episode at most this often per client
+
+    def __init__(self, server, compression=0, preroll=0):
+        self.server = server
+        self.compression = compression
+        self.preroll = preroll  # milliseconds of history to start with
+        self.ring = server.streams[compression].ring if compression else server.ring
+        self.ident = None
+        self.transport = None
+        self.socket = None
+        self.address = None
+        self.port = None
+        self.paused = False
+        self.write_buffer_high = Client.write_buffer_high
+        self.sent_dongle_id = False
+        self.command_buffer = b''
+        self.channel = None
+        self.channel_offset = 0
+        self.channel_rate = 0
+        # metrics, plain counters only ever changed by the event loop thread of this client
+        self.bytes_written = 0
+        self.last_bytes_sent = 0
+        self.send_rate = 0
+        self.drops = 0
+        self.dropped_bytes = 0
+        self.max_lag_seen = 0
+        self.lag_episodes = 0
+        self.episode_start = None  # time of the first drop of the current lag episode
+        self.last_drop = 0.0
+        self.last_lag_log = -self.lag_log_interval
+        self.episodes_not_logged = 0
+
+    def connection_made(self, transport):
+        self.address, self.port = (transport.get_extra_info('peername') or ('', 0))[:2]
+        if not ip_access_control(self.address):
+            LOGGER.info("client denied: %s blocked by ip", self.address)
+            transport.abort()
+            return
+        self.transport = transport
+        # paused as soon as the transport holds anything, resumed once it has sent it all: the ring is the buffer
+        transport.set_write_buffer_limits(0, 0)
+        # the socket of the transport, for sendmsg(), which the transport keeps owning (see connection_lost)
+        self.socket = socket.socket(fileno=transport.get_extra_info('socket').fileno())
+        self.start_time = time.time()
+        self.cursor = self.ring.head  # start at the live edge of the shared stream...
+        if self.preroll:
+            self.rewind(self.preroll)  # ...or in the past
+        self.server.add_client(self)
+        self.pump()
+
+    def data_received(self, data):
+        self.command_buffer += data
+        while len(self.command_buffer) >= 5:
+            command = bytearray(self.command_buffer[:5])
+            self.command_buffer = self.command_buffer[5:]
+            if command[0] in CLIENT_COMMANDS:
+                METRICS.commands[command[0], 'local'] += 1
+                self.command_allowed(command)  # applied to this client right away, never forwarded
+            else:
+                self.server.handle_command(self, command)
 
     def command_allowed(self, command):
-        global sample_rate
         param = struct.unpack("I", command[1:5])[0]
         param = socket.ntohl(param)
         command_id = command[0]
-        if time.time() - self.start_time < CONFIG.client_cant_set_until and not (CONFIG.first_client_can_set and self.ident == 0):
-            LOGGER.info("deny: %s -> client can't set anything until %d seconds", self, CONFIG.client_cant_set_until)
+        config = self.server.config
+        # the commands of CLIENT_COMMANDS only change what this client receives, so they are not held back
+        if command_id not in CLIENT_COMMANDS and time.time() - self.start_time < config.client_cant_set_until and not (config.first_client_can_set and self.ident == 0):
+            LOGGER.info("deny: %s -> client can't set anything until %d seconds", self, config.client_cant_set_until)
             return 0
         if command_id == 1:
-            if any(a <= param <= b for a, b in CONFIG.freq_allowed_ranges):
+            if any(a <= param <= b for a, b in config.freq_allowed_ranges):
                 LOGGER.debug("allow: %s -> set freq %s", self, param)
                 return 1
             else:
                 LOGGER.debug("deny: %s -> set freq - out of range: %s", self, param)
         elif command_id == 2:
-            if CONFIG.allow_sample_rate_set:
+            if config.allow_sample_rate_set:
                 LOGGER.debug("allow: %s -> set sample rate: %s", self, param)
-                sample_rate = param
+                self.server.sample_rate = param
                 return True
             LOGGER.debug("deny: %s -> set sample rate: %s", self, param)
             return 0  # ordinary clients are not allowed to do this
         elif command_id == 3:
-            LOGGER.debug("%s: %s -> set gain mode: %s", 'allow' if CONFIG.allow_gain_set else 'deny', self, param)
-            return CONFIG.allow_gain_set
+            LOGGER.debug("%s: %s -> set gain mode: %s", 'allow' if config.allow_gain_set else 'deny', self, param)
+            return config.allow_gain_set
         elif command_id == 4:
             LOGGER.debug("deny/allow: %s -> set gain: %s", self, param)
-            return CONFIG.allow_gain_set
+            return config.allow_gain_set
         elif command_id == 5:
             LOGGER.debug("deny: %s -> set freq correction: %s", self, param)
             return 0
         elif command_id == 6:
             LOGGER.debug("deny/allow: %s -> set if stage gain", self)
-            return CONFIG.allow_gain_set
+            return config.allow_gain_set
         elif command_id == 7:
             LOGGER.debug("deny: %s -> set test mode", self)
             return 0
         elif command_id == 8:
             LOGGER.debug("deny/allow: %s -> set agc mode", self)
-            return CONFIG.allow_gain_set
+            return config.allow_gain_set
         elif command_id == 9:
             LOGGER.debug("deny: %s -> set direct sampling", self)
             return 0
@@ -216,282 +848,1975 @@ class Client(asyncore.dispatcher):
             return 0
         elif command_id == 13:
             LOGGER.debug("deny/allow: %s -> set tuner gain by index", self)
-            return CONFIG.allow_gain_set
+            return config.allow_gain_set
+        elif command_id == SET_CHANNEL_OFFSET:
+            self.set_channel(struct.unpack('>i', bytes(command[1:5]))[0], self.channel_rate)
+        elif command_id == SET_CHANNEL_RATE:
+            self.set_channel(self.channel_offset, param)
+        elif command_id == SET_COMPRESSION:
+            self.set_compression(param)
+        elif command_id == SET_PREROLL:
+            if not config.preroll_seconds:
+                LOGGER.debug("deny: %s -> set preroll: preroll_seconds is 0", self)
+            elif self.compression:
+                LOGGER.debug("deny: %s -> set preroll: not available with compression", self)
+            elif self.bytes_written > len(self.server.dongle_identifier):
+                # going back once I/Q data has been sent would repeat it
+                LOGGER.debug("deny: %s -> set preroll: only before the first I/Q data", self)
+            else:
+                LOGGER.debug("allow: %s -> set preroll: %d ms", self, param)
+                self.rewind(param)
+        elif command_id == SET_UPSTREAM:
+            self.set_upstream(param)
         else:
             LOGGER.debug("deny: %s sent an ivalid command: %s", self, param)
         return 0
 
-    def handle_error(self):
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        LOGGER.info("client error: %s", self)
-        LOGGER.exception(exc_value)
-        self.close()
+    def set_compression(self, codec_id):
+        if codec_id and codec_id not in self.server.streams:
+            LOGGER.debug("deny: %s -> set compression: codec %d is not in compression_codecs", self, codec_id)
+        elif codec_id and self.channel is not None:
+            LOGGER.debug("deny: %s -> set compression: not available in channel mode", self)
+        elif codec_id != self.compression:
+            LOGGER.debug("allow: %s -> set compression: %s", self, self.server.streams[codec_id].name if codec_id else 'off')
+            previous, self.compression = self.compression, codec_id
+            self.ring = self.server.streams[codec_id].ring if codec_id else self.server.ring
+            self.cursor = self.ring.head  # compressed streams can only be joined at a frame boundary
+            self.server.compression_changed(self, previous)
+
+    def set_upstream(self, index):
+        # moves the client over to another upstream, it goes on at the live edge of its stream
+        # (the dongle identifier it has got is the one of the upstream it has connected to)
+        if isinstance(self.server, WorkerServer):
+            LOGGER.debug("deny: %s -> set upstream: not available with sender_workers", self)
+        elif index >= len(SERVERS) or SERVERS[index].workers:
+            LOGGER.debug("deny: %s -> set upstream: no upstream %d without sender_workers", self, index)
+        elif self.compression and self.compression not in SERVERS[index].streams:
+            LOGGER.debug("deny: %s -> set upstream: codec %d is not in the compression_codecs of upstream %d", self, self.compression, index)
+        elif SERVERS[index] is not self.server:
+            LOGGER.debug("allow: %s -> set upstream: %s", self, SERVERS[index].config.name)
+            self.server.remove_client(self)
+            self.server = SERVERS[index]
+            self.ring = self.server.streams[self.compression].ring if self.compression else self.server.ring
+            self.cursor = self.ring.head
+            self.server.add_client(self)
+            self.pump()
+
+    def rewind(self, milliseconds):
+        # Time shift: go back in the ring, which is the history shared by all clients, nothing is copied.
+        # A client cannot go back farther than preroll_seconds, or than it could catch up from.
+        seconds = min(milliseconds / 1000.0, self.server.config.preroll_seconds)
+        back = min(int(2 * self.server.ring_sample_rate * seconds), self.max_lag() * 3 // 4, self.ring.head) & ~1
+        self.cursor = self.ring.head - back
+
+    def set_channel(self, offset, rate):
+        if self.compression:
+            LOGGER.debug("deny: %s -> set channel: not available with compression", self)
+        elif not self.server.config.allow_channel_set:
+            LOGGER.debug("deny: %s -> set channel: not allowed", self)
+        elif np is None:
+            LOGGER.debug("deny: %s -> set channel: numpy is not installed", self)
+        elif (abs(offset) > self.server.ring_sample_rate // 2 or rate > self.server.ring_sample_rate
+              or rate and rate * Decimator.max_decimation < self.server.ring_sample_rate):
+            LOGGER.debug("deny: %s -> set channel - out of range: offset %d Hz, sample rate %d", self, offset, rate)
+        else:
+            self.channel_offset, self.channel_rate = offset, rate
+            self.channel = Channelizer(self.server.ring_sample_rate, offset, rate) if rate else None
+            LOGGER.debug("allow: %s -> set channel: offset %d Hz, sample rate %d", self, offset, self.channel.output_rate if rate else self.server.ring_sample_rate)
 
-    def handle_close(self):
-        self.close()
+    def connection_lost(self, exc):
+        if self.transport is None:  # denied by ip
+            return
+        self.socket.detach()  # the transport closes it
+        self.server.remove_client(self)
+        if exc is not None:
+            LOGGER.info("client error: %s: %s", self, exc)
         LOGGER.info("client disconnected: %s", self)
 
-    def writable(self):
-        # print("queryWritable",not self.waiting_data.empty())
-        return not self.waiting_data.empty()
+    def pause_writing(self):
+        self.paused = True
 
-    def handle_write(self):
-        if not self.sent_dongle_id:
-            if RTL_TCP.dongle_identifier:
-                self.send(RTL_TCP.dongle_identifier)
-                self.sent_dongle_id = True
+    def resume_writing(self):
+        self.paused = False
+        self.pump()
+
+    def pump(self):
+        # Called whenever there may be something to send: new data in the ring, or a drained transport.
+        if self.transport is None or self.transport.is_closing():
             return
-        # print("write2client",self.waiting_data.qsize())
-        next = self.last_waiting_buffer + self.waiting_data.get()
-        sent = asyncore.dispatcher.send(self, next)
-        self.last_waiting_buffer = next[sent:]
+        if not self.sent_dongle_id:
+            if not self.server.dongle_identifier:
+                return
+            self.transport.write(self.server.dongle_identifier)
+            self.bytes_written += len(self.server.dongle_identifier)
+            self.sent_dongle_id = True
+        self.check_lag()
+        if self.channel is not None and self.channel.input_rate != self.server.ring_sample_rate:
+            self.channel = Channelizer(self.server.ring_sample_rate, self.channel_offset, self.channel_rate)
+        start = self.cursor
+        while not self.paused and self.cursor < self.ring.head and not self.transport.is_closing():
+            read_from = self.cursor
+            views = self.ring.read(self.cursor, min(self.max_send, self.write_buffer_high))
+            if self.channel is None:
+                self.write_views(views)
+                length = sum(len(view) for view in views)
+                self.cursor += length
+                self.bytes_written += length
+            else:
+                length = sum(len(view) for view in views) & ~1  # whole I/Q samples only
+                if not length:
+                    break
+                data = views[0] if len(views) == 1 else b''.join(views)
+                output = self.channel.process(data[:length])
+                self.transport.write(output)
+                self.cursor += length
+                self.bytes_written += len(output)
+            if not self.ring.intact(read_from):
+                self.overwritten(read_from)
+        if self.cursor != start and self.cursor == self.ring.head and not self.transport.get_write_buffer_size():
+            # the newest data has just been taken by the kernel
+            self.server.latency.add(time.monotonic() - self.ring.write_time)
+
+    def write_views(self, views):
+        # The views (two when the ring wraps around) go straight to the kernel in one sendmsg(). What it does not take
+        # goes to the transport, which pauses the client until it has sent that. The asyncio transport copies it,
+        # uvloop would keep a reference to the view instead, which the producer overwrites later: it gets a copy.
+        sent = 0 if self.transport.get_write_buffer_size() else self.sendmsg(views)
+        for view in views:
+            if sent < len(view):
+                remainder = view[sent:]
+                self.transport.write(bytes(remainder) if CONFIG.use_uvloop and uvloop else remainder)
+            sent = max(0, sent - len(view))
+
+    def sendmsg(self, buffers):
+        # scatter/gather send, returns how many bytes the kernel took
+        try:
+            return self.socket.sendmsg(buffers)
+        except OSError:  # would block, or the connection is broken, which the transport finds out on its next write
+            return 0
+
+    def overwritten(self, read_from):
+        # Only in a sender worker, whose producer writes in parallel: it has overwritten the data while it was being
+        # copied, so what went out is torn. It counts as dropped, and the client goes on from the newest data.
+        LOGGER.debug("%s: %d bytes were overwritten while they were sent", self, self.cursor - read_from)
+        self.drops += 1
+        self.dropped_bytes += self.cursor - read_from
+        self.cursor = self.ring.head
 
     def close(self):
-        SERVER.remove_client(self)
-        asyncore.dispatcher.close(self)
+        self.transport.close()
 
-    def add_data(self, data):
-        # print("self %d size: %d"%(self.ident,self.waiting_data.qsize()))
-        if self.waiting_data:
-            if self.waiting_data.full():
-                if CONFIG.cache_full_behaviour == 0:
-                    LOGGER.error("client cache full, dropping samples: %s", self)
-                    while not self.waiting_data.empty():  # clear queue
-                        self.waiting_data.get(False, None)
-                elif CONFIG.cache_full_behaviour == 1:
-                    # rather closing client:
-                    LOGGER.error("client cache full, dropping client: %s", self)
-                    self.close()
-                elif CONFIG.cache_full_behaviour == 2:
-                    pass  # client cache full, just not taking care
-                else:
-                    LOGGER.error("invalid value for CONFIG.cache_full_behaviour")
-            else:
-                self.waiting_data.put(data)
+    def abort(self):
+        # right away, without sending what is still buffered for a slow client, even in the kernel (it sends a RST)
+        self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.transport.abort()
+
+    def lag(self):
+        # bytes between the newest data and the oldest byte not yet taken by the kernel
+        return self.ring.head - self.cursor + self.transport.get_write_buffer_size()
+
+    def buffered(self):
+        # the only memory of its own a client has: the copy of what the kernel has not taken yet
+        return self.transport.get_write_buffer_size()
+
+    def max_lag(self):
+        return min(self.server.config.buffer_size, self.ring.max_lag)
+
+    def downgrade(self):
+        # lets the transport buffer only half as much for this client (it sends less at once), False if it is at the minimum already
+        if self.write_buffer_high <= self.min_write_buffer_high:
+            return False
+        self.write_buffer_high //= 2
+        return True
+
+    def check_lag(self):
+        # the producer never looks at clients, so slow ones are found here by how far they lag behind
+        lag = self.lag()
+        max_lag = self.max_lag()
+        config = self.server.config
+        if lag > self.max_lag_seen:
+            self.max_lag_seen = lag
+        # only what is still in the ring can be skipped, what the transport holds is on its way already
+        lag = self.ring.head - self.cursor
+        if lag <= max_lag:
+            if self.episode_start is not None and time.monotonic() - self.last_drop > self.lag_episode_gap:
+                LOGGER.debug("client caught up after lagging for %.1f s: %s", self.last_drop - self.episode_start, self)
+                self.episode_start = None
+            return
+        cursor = self.cursor
+        if config.cache_full_behaviour == 0:
+            LOGGER.error("client cache full, dropping samples: %s", self)
+            self.cursor = self.ring.head
+        elif config.cache_full_behaviour == 1:
+            # rather closing client:
+            LOGGER.error("client cache full, dropping client: %s", self)
+            self.abort()
+        elif config.cache_full_behaviour == 2:
+            # client cache full, just not taking care: keep the oldest samples that are still intact
+            # (compressed streams can only be resumed at a frame boundary, which the head is)
+            self.cursor = self.ring.head if self.compression else self.cursor + ((lag - max_lag + 1) & ~1)
+        elif config.cache_full_behaviour == 3:
+            # skip ahead to the live edge, keeping skip_ahead_margin seconds of samples to start with again
+            # (whole I/Q samples are skipped, compressed streams go to the head, which is a frame boundary)
+            keep = min(int(2 * self.server.ring_sample_rate * config.skip_ahead_margin), max_lag // 2)
+            self.cursor = self.ring.head if self.compression else self.cursor + (max(0, self.ring.head - keep - self.cursor) & ~1)
+        else:
+            LOGGER.error("invalid value for cache_full_behaviour")
+            return
+        self.cursor = min(self.cursor, self.ring.head)
+        self.drops += 1
+        self.dropped_bytes += self.cursor - cursor
+        now = time.monotonic()
+        if self.episode_start is None:
+            self.episode_start = now
+            self.lag_episodes += 1
+            if config.cache_full_behaviour == 3:
+                self.log_lag_episode(now, lag)
+        self.last_drop = now
+
+    def log_lag_episode(self, now, lag):
+        # one line per episode, and at most one every lag_log_interval seconds, however slow the client is
+        if now - self.last_lag_log < self.lag_log_interval:
+            self.episodes_not_logged += 1
+            return
+        LOGGER.warning("client is lagging %d bytes behind, skipping ahead to the newest samples: %s (%d lag episodes so far%s)", lag, self, self.lag_episodes,
+                       ", %d of them not logged" % self.episodes_not_logged if self.episodes_not_logged else "")
+        self.last_lag_log = now
+        self.episodes_not_logged = 0
+
+    def sample(self, elapsed):
+        bytes_sent = self.bytes_sent()
+        self.send_rate = int((bytes_sent - self.last_bytes_sent) / elapsed)
+        self.last_bytes_sent = bytes_sent
+
+    def bytes_sent(self):
+        # handed over to the kernel
+        return self.bytes_written - self.transport.get_write_buffer_size()
+
+    def metrics(self):
+        return {
+            'ident': self.ident, 'address': self.address, 'port': self.port, 'upstream': self.server.config.name,
+            'bytes_sent': self.bytes_sent(), 'send_rate': self.send_rate, 'lag': self.lag(), 'buffered': self.buffered(),
+            'drops': self.drops, 'dropped_bytes': self.dropped_bytes, 'max_lag': self.max_lag_seen, 'lag_episodes': self.lag_episodes,
+            'compression': self.compression, 'channel_rate': self.channel.output_rate if self.channel is not None else 0,
+        }
 
     def __str__(self):
         return '{}@{}:{}'.format(self.ident, self.address, self.port)
 
 
-class ServerAsyncore(asyncore.dispatcher):
+class LatencyStats(object):
+    '''How long the newest I/Q data spends inside rtl_mus, from the upstream to the kernel of the clients.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
 
-    def __init__(self, addr, port):
-        self.clients = set()
-        self.clients_mutex = multiprocessing.Lock()
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def log(self):
+        if self.count:
+            LOGGER.info("%s: latency inside rtl_mus: avg %.2f ms, max %.2f ms", self.name, 1000 * self.total / self.count, 1000 * self.max)
+        self.reset()
+        LOOP.call_later(CONFIG.latency_log_interval, self.log)
+
+
+class TimingHistogram(object):
+    '''Durations of one hot path (profile_timings), in buckets of powers of two from 1 us to about 1 s.'''
+
+    bounds = tuple(2 ** i / 1e6 for i in range(21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is above the largest bound
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.total}
+
+
+TIMINGS = {}  # TimingHistogram by the name of the hot path, empty unless profile_timings is set
+
+
+def timed(function, histogram):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.add(time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_hot_paths():
+    # Replaces the methods of the hot paths with timed ones. This is done once at the start, before the
+    # sender workers are forked, so that without profile_timings they are not even wrapped.
+    for name, (cls, method) in HOT_PATHS.items():
+        TIMINGS[name] = TimingHistogram()
+        setattr(cls, method, timed(getattr(cls, method), TIMINGS[name]))
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stacks of all the threads of the process (the event loop, the DSP and recorder threads) every
+    profile_interval seconds, and counts them in the folded format of flamegraph.pl, inferno or speedscope:
+    one line per stack, the thread and its frames from the root separated by ';', then the count.
+    It runs in a thread of its own while started, nothing runs while it is not.
+    '''
+
+    def __init__(self):
+        self.stacks = None  # collections.Counter while started
+
+    @property
+    def running(self):
+        return self.stacks is not None
+
+    def start(self, interval):
+        self.stacks = collections.Counter()
+        thread.start_new_thread(self.sample_thread, (interval, self.stacks))
+
+    def stop(self):
+        # returns the samples as folded stacks
+        stacks, self.stacks = self.stacks, None
+        return ''.join('%s %d\n' % item for item in sorted(dict(stacks).items()))
+
+    def sample_thread(self, interval, stacks):
+        me = thread.get_ident()
+        while self.stacks is stacks:
+            names = dict((named.ident, named.name) for named in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append(names.get(ident, 'thread'))  # the threads of thread.start_new_thread have no name, their first frame tells
+                stacks[';'.join(reversed(frames))] += 1
+            time.sleep(interval)
+
+
+PROFILER = SamplingProfiler()
+
+
+def toggle_profiler():
+    # on SIGUSR1: starts the profiler, or stops it and writes the stacks to profile_path
+    if not PROFILER.running:
+        PROFILER.start(CONFIG.profile_interval)
+        LOGGER.info("profiler started")
+        return
+    stacks = PROFILER.stop()
+    path = CONFIG.profile_path.format(pid=os.getpid())
+    try:
+        with open(path, 'w') as f:
+            f.write(stacks)
+        LOGGER.info("profiler stopped, stacks written to %s", path)
+    except IOError as exc:
+        LOGGER.error("profiler stopped, cannot write %s: %s", path, exc)
+
+
+memory_check_interval = 0.5
+
+
+def enforce_memory_budget(budget):
+    # Runs every memory_check_interval seconds. The ring is shared, so a lagging client costs no memory,
+    # but what the transports buffer is a copy per client. Above the budget the slowest clients are
+    # downgraded first (they may buffer less from now on), and dropped if they cannot be downgraded anymore.
+    # The budget is shared by the clients of all the upstreams served by this process.
+    clients = [client for server in SERVERS for client in server.clients if isinstance(client, Client)]
+    used = sum(client.buffered() for client in clients)
+    if used > budget:
+        for client in sorted(clients, key=lambda client: client.lag(), reverse=True):
+            if used <= budget:
+                break
+            buffered = client.buffered()
+            if client.downgrade():
+                LOGGER.info("client memory budget exceeded, downgrading client: %s (buffer limit: %d bytes)", client, client.write_buffer_high)
+                used -= max(0, buffered - client.write_buffer_high)
+            else:
+                LOGGER.error("client memory budget exceeded, dropping client: %s", client)
+                client.drops += 1
+                client.abort()
+                used -= buffered
+    LOOP.call_later(memory_check_interval, enforce_memory_budget, budget)
+
+
+class Metrics(object):
+    '''
+    Numbers for the metrics endpoint. The counters are plain integers, each changed by one thread only,
+    so that counting costs no lock on the hot path; the rates are computed from them once per second.
+    '''
+
+    interval = 1.0
+    lag_window = 60  # max_loop_lag is the largest over this many samples
+
+    def __init__(self):
+        self.commands = collections.Counter()  # (command id, 'accepted' / 'denied' / 'local') -> count
+        self.loop_lag = 0.0
+        self.loop_lags = collections.deque(maxlen=self.lag_window)
+
+    def start(self):
+        self.last = LOOP.time()
+        self.expected = self.last + self.interval
+        LOOP.call_at(self.expected, self.sample)
+
+    def sample(self):
+        now = LOOP.time()
+        # how late this timer has run is how long the event loop was busy with other callbacks
+        self.loop_lag = max(0.0, now - self.expected)
+        self.loop_lags.append(self.loop_lag)
+        elapsed = now - self.last
+        self.last = now
+        for server in SERVERS:
+            if server.rtl_tcp is not None:
+                server.rtl_tcp.sample(elapsed)
+            for client in server.clients:
+                if isinstance(client, Client):
+                    client.sample(elapsed)
+        self.expected = now + self.interval
+        LOOP.call_at(self.expected, self.sample)
+
+    def all_timings(self):
+        # of the main process and of the sender workers, as last reported
+        timings = dict((name, histogram.snapshot()) for name, histogram in TIMINGS.items())
+        for server in SERVERS:
+            for worker in server.workers:
+                for name, histogram in worker.timings.items():
+                    total = timings.setdefault(name, TimingHistogram().snapshot())
+                    total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+                    total['sum'] += histogram['sum']
+        return timings
+
+    def all_commands(self):
+        commands = collections.Counter(self.commands)
+        for server in SERVERS:
+            for worker in server.workers:
+                commands.update(worker.commands)
+        return commands
+
+    def snapshot(self):
+        return {
+            'clients': sorted((client.metrics() for server in SERVERS for client in server.clients), key=lambda client: (client['upstream'], client['ident'])),
+            'upstreams': [server.rtl_tcp.metrics() for server in SERVERS],
+            'commands': [{'command': command_id, 'result': result, 'count': count} for (command_id, result), count in sorted(self.all_commands().items())],
+            'event_loop': {'lag': self.loop_lag, 'max_lag': max(self.loop_lags) if self.loop_lags else 0.0},
+            'timings': self.all_timings(),
+        }
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP rtl_mus_{} {}'.format(name, help))
+            lines.append('# TYPE rtl_mus_{} {}'.format(name, kind))
+            for labels, value in samples:
+                labels = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+                lines.append('rtl_mus_{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+        clients = snapshot['clients']
+        client_labels = [(('upstream', client['upstream']), ('client', client['ident']), ('address', client['address'])) for client in clients]
+        metric('clients', 'gauge', 'Connected clients.', [((), len(clients))])
+        for name, kind, help, key in (
+                ('client_sent_bytes_total', 'counter', 'Bytes sent to the client.', 'bytes_sent'),
+                ('client_send_rate_bytes', 'gauge', 'Bytes per second sent to the client.', 'send_rate'),
+                ('client_lag_bytes', 'gauge', 'Bytes between the newest data and the oldest one not yet sent to the client.', 'lag'),
+                ('client_buffered_bytes', 'gauge', 'Bytes buffered for the client, waiting for the kernel to take them.', 'buffered'),
+                ('client_drops_total', 'counter', 'Times data was skipped because the client was too slow.', 'drops'),
+                ('client_dropped_bytes_total', 'counter', 'Bytes skipped because the client was too slow.', 'dropped_bytes'),
+                ('client_max_lag_bytes', 'gauge', 'The largest lag of the client so far.', 'max_lag'),
+                ('client_lag_episodes_total', 'counter', 'Times the client has started to fall behind too much.', 'lag_episodes')):
+            metric(name, kind, help, [(labels, client.get(key, 0)) for labels, client in zip(client_labels, clients)])
+        upstreams = snapshot['upstreams']
+        upstream_labels = [(('upstream', upstream['name']),) for upstream in upstreams]
+        metric('upstream_received_bytes_total', 'counter', 'Bytes received from rtl_tcp.', [(labels, upstream['received_bytes']) for labels, upstream in zip(upstream_labels, upstreams)])
+        metric('upstream_rate_bytes', 'gauge', 'Bytes per second received from rtl_tcp.', [(labels, upstream['rate']) for labels, upstream in zip(upstream_labels, upstreams)])
+        metric('upstream_reconnects_total', 'counter', 'Times the connection to rtl_tcp was lost, failed, or dropped for sending nothing.',
+               [(labels, upstream['reconnects']) for labels, upstream in zip(upstream_labels, upstreams)])
+        recorders = [(labels, upstream['recorder']) for labels, upstream in zip(upstream_labels, upstreams) if upstream['recorder'] is not None]
+        for name, kind, help, key in (
+                ('recorder_recorded_bytes_total', 'counter', 'Bytes written to the recording.', 'recorded_bytes'),
+                ('recorder_lag_bytes', 'gauge', 'Bytes between the newest data and the oldest one not yet recorded.', 'lag'),
+                ('recorder_drops_total', 'counter', 'Times data was skipped because the recording was too slow.', 'drops'),
+                ('recorder_dropped_bytes_total', 'counter', 'Bytes skipped because the recording was too slow.', 'dropped_bytes'),
+                ('recorder_errors_total', 'counter', 'Errors writing the recording, e.g. the disk was full.', 'errors')):
+            if recorders:
+                metric(name, kind, help, [(labels, recorder[key]) for labels, recorder in recorders])
+        metric('commands_total', 'counter', 'Commands of the clients, by command id and result.',
+               [((('command', command['command']), ('result', command['result'])), command['count']) for command in snapshot['commands']])
+        for direction in ('input', 'output'):
+            dsp = [(labels, upstream['dsp']) for labels, upstream in zip(upstream_labels, upstreams) if upstream['dsp'] is not None]
+            if dsp:
+                metric('dsp_{}_bytes_total'.format(direction), 'counter', 'Bytes of the DSP pipeline {}.'.format(direction), [(labels, stats[direction + '_bytes']) for labels, stats in dsp])
+                metric('dsp_{}_rate_bytes'.format(direction), 'gauge', 'Bytes per second of the DSP pipeline {}.'.format(direction), [(labels, stats[direction + '_rate']) for labels, stats in dsp])
+        if dsp:
+            metric('dsp_errors_total', 'counter', 'Blocks a DSP stage could not process, e.g. data it could not decode.', [(labels, stats['errors']) for labels, stats in dsp])
+        metric('tuner_setting', 'gauge', 'The last value of each tuner setting sent to rtl_tcp.',
+               [((('upstream', server.config.name), ('setting', COMMAND_NAMES.get(command_id, command_id))), struct.unpack('>I', command[1:5])[0])
+                for server in SERVERS for command_id, command in sorted(server.rtl_tcp.state.commands.items())])
+        metric('event_loop_lag_seconds', 'gauge', 'How late the event loop ran the last metrics timer.', [((), snapshot['event_loop']['lag'])])
+        metric('event_loop_max_lag_seconds', 'gauge', 'The same, the largest in the last {} seconds.'.format(int(self.lag_window * self.interval)), [((), snapshot['event_loop']['max_lag'])])
+        if snapshot['timings']:
+            metric('timing_seconds', 'histogram', 'Time spent in each hot path, per call (profile_timings).', [])
+            for name, histogram in sorted(snapshot['timings'].items()):
+                cumulative = 0
+                for bound, count in zip(TimingHistogram.bounds + ('+Inf',), histogram['counts']):
+                    cumulative += count
+                    lines.append('rtl_mus_timing_seconds_bucket{{path="{}",le="{}"}} {}'.format(name, bound, cumulative))
+                lines.append('rtl_mus_timing_seconds_sum{{path="{}"}} {}'.format(name, histogram['sum']))
+                lines.append('rtl_mus_timing_seconds_count{{path="{}"}} {}'.format(name, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+SERVERS = []  # one Server per upstream
+profile_max_seconds = 300
+
+
+async def handle_metrics_request(reader, writer):
+    # a minimal HTTP/1.0 server: GET /metrics (Prometheus text format), GET / or /metrics.json (JSON),
+    # GET /state (the tuner state of the first upstream, JSON), GET /state/<name> (the one of that upstream),
+    # GET /profile?seconds=N (runs the sampling profiler of the main process for N seconds, folded stacks)
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        parts = request.split(b' ', 2)
+        path, _, query = parts[1].partition(b'?') if len(parts) == 3 else (b'', b'', b'')
+        if path == b'/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4', METRICS.prometheus()
+        elif path in (b'/', b'/metrics.json'):
+            status, content_type, body = '200 OK', 'application/json', json.dumps(METRICS.snapshot(), indent=1)
+        elif path == b'/state' or path.startswith(b'/state/'):
+            name = path[len(b'/state/'):].decode(errors='replace')
+            servers = [server for server in SERVERS if server.config.name == name] if name else SERVERS[:1]
+            if servers:
+                status, content_type, body = '200 OK', 'application/json', json.dumps(servers[0].rtl_tcp.state.snapshot(), indent=1)
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'no such upstream\n'
+        elif path == b'/profile':
+            try:
+                seconds = min(float(urllib.parse.parse_qs(query.decode()).get('seconds', ['10'])[0]), profile_max_seconds)
+            except ValueError:
+                seconds = None
+            if seconds is None:
+                status, content_type, body = '400 Bad Request', 'text/plain', 'seconds must be a number\n'
+            elif PROFILER.running:
+                status, content_type, body = '409 Conflict', 'text/plain', 'the profiler is running already\n'
+            else:
+                PROFILER.start(CONFIG.profile_interval)
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    stacks = PROFILER.stop()
+                status, content_type, body = '200 OK', 'text/plain', stacks
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+        body = body.encode()
+        writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, content_type, len(body)).encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class RemoteClient(object):
+    '''A client served by a sender worker, as the main process sees it.'''
+
+    def __init__(self, addr, port, worker, compression):
+        self.ident = None
+        self.address = addr
+        self.port = port
+        self.compression = compression  # as the worker last reported it
+        self.server = worker.server
+        self.worker = worker
+        self.start_time = time.time()
+        self.stats = {}  # the metrics of the client, as last reported by the worker
+
+    def metrics(self):
+        return dict(self.stats, ident=self.ident, address=self.address, port=self.port, upstream=self.server.config.name)
+
+    command_allowed = Client.command_allowed
+    __str__ = Client.__str__
+
+
+def listening_socket(addr, port):
+    # all interfaces: one dual-stack socket, IPv4 clients come as IPv4-mapped IPv6 addresses (or IPv4 only, without IPv6)
+    if addr:
+        family, _, _, _, address = socket.getaddrinfo(addr, port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    elif socket.has_ipv6:
+        family, address = socket.AF_INET6, ('::', port)
+    else:
+        family, address = socket.AF_INET, ('', port)
+    try:
+        listener = socket.socket(family, socket.SOCK_STREAM)
+    except OSError:
+        if addr:
+            raise
+        family, address = socket.AF_INET, ('', port)  # IPv6 is disabled on this host
+        listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if family == socket.AF_INET6:
+        listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    listener.bind(address)
+    listener.listen(5)
+    listener.setblocking(False)
+    return listener
+
+
+class Server(object):
+    '''The clients of one upstream, and everything they share: the ring, the compressed streams, the sender workers, the tuner.'''
+
+    def __init__(self, config, ring, streams, workers=()):
+        # Copy-on-write: adding or removing a client replaces the set, so the data path can always go on
+        # with the set it has, and never waits for connecting or disconnecting clients.
+        self.clients = frozenset()
+        self.config = config
+        self.loop_thread = thread.get_ident()
+        self.ring = ring
+        self.streams = streams  # CompressedStream by codec id
+        self.workers = workers
+        for worker in workers:
+            worker.server = self
+        self.sample_rate = config.initial_sample_rate  # of the upstream
+        self.decimation = 1  # of the DSP pipeline, once it is started
+        self.rtl_tcp = None  # RtlTcp, once the DSP pipeline is started
+        self.workers_identifier = b''
+        self.workers_sample_rate = None
         self.client_count = 0
-        asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((addr, port))
-        self.listen(5)
-        LOGGER.info("Server listening on port: %s", CONFIG.my_listening_port)
-
-    def handle_accept(self):
-        accept = self.accept()
-        if accept is None:  # not sure if required
+        self.wake_pending = False
+        self.latency = LatencyStats(config.name)
+        self.command_scheduler = CommandScheduler(self)
+        self.multicast = MulticastSender(self) if config.multicast_group else None
+        self.recorder = None  # Recorder, once the upstream is started
+        if config.latency_log_interval:
+            LOOP.call_later(config.latency_log_interval, self.latency.log)
+        self.listen(config.my_ip, config.my_listening_port, 0)
+        if config.compressed_listening_port:
+            # clients of this port get the compressed stream right away
+            self.listen(config.my_ip, config.compressed_listening_port, frame_codec_id(config.compressed_listening_codec))
+        if config.preroll_listening_port:
+            # clients of this port start with the last preroll_seconds of I/Q data
+            self.listen(config.my_ip, config.preroll_listening_port, 0, int(1000 * config.preroll_seconds))
+
+    def listen(self, addr, port, compression, preroll=0):
+        listener = listening_socket(addr, port)
+        if self.workers:
+            # accepted sockets are handed over to the sender workers, so accept them ourselves
+            LOOP.add_reader(listener.fileno(), self.handle_accept, listener, compression, preroll)
+        else:
+            LOOP.run_until_complete(LOOP.create_server(lambda: Client(self, compression, preroll), sock=listener, backlog=5))
+        LOGGER.info("Server listening on port: %s (%s)", port, self.config.name)
+
+    @property
+    def dongle_identifier(self):
+        return self.rtl_tcp.state.dongle_identifier
+
+    def handle_accept(self, listener, compression, preroll):
+        try:
+            sock, peer = listener.accept()
+            addr, port = peer[:2]
+        except BlockingIOError:
             return
-        socket, (addr, port) = accept
         if ip_access_control(addr):
-            client = Client(socket, addr, port, self.client_count)
-            self.client_count += 1
-            self.clients_mutex.acquire()
-            self.clients.add(client)
-            LOGGER.info("client accepted: %s  users now: %d", client, len(self.clients))
-            self.clients_mutex.release()
+            worker = min(self.workers, key=lambda worker: len(worker.clients))
+            client = RemoteClient(addr, port, worker, compression)
+            self.add_client(client)
+            worker.add_client(client, sock, compression, preroll)  # which closes sock once it is passed on
         else:
             LOGGER.info("client denied: %s blocked by ip", addr)
-            socket.close()
+            sock.close()
 
-    def add_data_to_clients(self, data):
+    def handle_command(self, client, command):
+        # every command ends up here, also the ones the sender workers received
+        if client.command_allowed(command):
+            METRICS.commands[command[0], 'accepted'] += 1
+            self.command_scheduler.submit(client, bytes(command))
+        else:
+            METRICS.commands[command[0], 'denied'] += 1
+
+    def add_client(self, client):
+        client.ident = self.client_count
+        self.client_count += 1
+        self.clients = self.clients | {client}
+        if client.compression:
+            self.streams[client.compression].subscribe()
+        LOGGER.info("client accepted: %s  users now: %d (%s)", client, len(self.clients), self.config.name)
+
+    def add_data(self, data):
         # might be called from:
-        # -> dsp_read
-        # -> rtl_tcp_asyncore.handle_read
-        # -> watchdog filling missing data
-        self.clients_mutex.acquire()
+        # -> the DSP pipeline (in the thread reading a DSP command, or in the event loop)
+        # -> RtlTcp.data_received
+        # The ring has a single producer, the event loop thread, so other threads hand their data over to it.
+        if thread.get_ident() == self.loop_thread:
+            self.add_data_to_clients(data)
+        else:
+            LOOP.call_soon_threadsafe(self.add_data_to_clients, data)
+
+    def add_data_to_clients(self, data):
+        # The data is written once into the shared ring, clients only move their cursor over it.
+        self.ring.write(data)
+        for stream in self.streams.values():
+            stream.write(data)
+        if self.multicast is not None:
+            self.multicast.send(data)
+        self.wake()
+
+    @property
+    def ring_sample_rate(self):
+        # of the I/Q data in the ring, after the DSP pipeline
+        return self.sample_rate // self.decimation
+
+    def wake(self):
+        # at most one pending wakeup however many chunks arrive meanwhile
+        if not self.wake_pending:
+            self.wake_pending = True
+            LOOP.call_soon(self.wake_clients)
+
+    def wake_clients(self):
+        self.wake_pending = False
+        if self.workers:
+            if self.workers_identifier != self.dongle_identifier:
+                self.workers_identifier = self.dongle_identifier
+                for worker in self.workers:
+                    worker.send_identifier(self.workers_identifier)
+            if self.workers_sample_rate != self.ring_sample_rate:
+                self.workers_sample_rate = self.ring_sample_rate
+                for worker in self.workers:
+                    worker.send_sample_rate(self.ring_sample_rate)
+            for worker in self.workers:
+                worker.wake()
+            return
         for client in self.clients:
-            client.add_data(data)
-        self.clients_mutex.release()
+            client.pump()
 
     def remove_client(self, client):
-        self.clients_mutex.acquire()
-        self.clients.remove(client)
-        self.clients_mutex.release()
+        if client in self.clients and client.compression:
+            self.streams[client.compression].unsubscribe()
+        self.clients = self.clients - {client}
+        self.command_scheduler.forget(client)
+
+    def compression_changed(self, client, previous):
+        if client in self.clients:
+            if previous:
+                self.streams[previous].unsubscribe()
+            if client.compression:
+                self.streams[client.compression].subscribe()
+
+
+# Multicast datagrams: magic, sequence number, offset of the payload in the stream, dongle identifier, payload.
+# The payload is plain I/Q, and it always starts with I, so lost datagrams can be replaced by null samples.
+MULTICAST_MAGIC = b'RMC1'
+MULTICAST_HEADER = struct.Struct('>4sIQ12s')
+
+
+class MulticastSender(object):
+    '''
+    Publishes the I/Q stream of a Server as UDP multicast datagrams, one transmission for any number
+    of receivers on the LAN (see multicast_upstream). A datagram that the socket cannot take right
+    now is dropped, the receivers fill the gap.
+    '''
+
+    def __init__(self, server):
+        config = server.config
+        self.server = server
+        self.address = (config.multicast_group, config.multicast_port)
+        # whole I/Q samples that fit in one datagram of multicast_mtu bytes with the IP and UDP headers
+        self.payload_size = (config.multicast_mtu - 28 - MULTICAST_HEADER.size) & ~1
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.multicast_ttl)
+        if config.multicast_interface:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(config.multicast_interface))
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        self.socket.setblocking(False)
+        self.sequence = 0
+        self.offset = 0  # of the next byte in the stream
+        self.odd_byte = b''
+        self.dropped = 0
+        LOGGER.info("%s: publishing the I/Q stream to multicast %s:%d", config.name, *self.address)
+
+    def send(self, data):
+        if self.odd_byte:
+            data = self.odd_byte + bytes(data)
+            self.odd_byte = b''
+        if len(data) % 2:  # the DSP pipeline may cut samples in two, datagrams always hold whole ones
+            data, self.odd_byte = data[:-1], bytes(data[-1:])
+        view = memoryview(data)
+        identifier = self.server.dongle_identifier
+        for start in range(0, len(view), self.payload_size):
+            payload = view[start:start + self.payload_size]
+            header = MULTICAST_HEADER.pack(MULTICAST_MAGIC, self.sequence & 0xffffffff, self.offset, identifier)
+            try:
+                self.socket.sendto(header + payload, self.address)
+            except OSError as exc:  # the socket buffer is full (or the network is down)
+                if not self.dropped:
+                    LOGGER.error("%s: multicast datagram dropped: %s", self.server.config.name, exc)
+                self.dropped += 1
+            self.sequence += 1
+            self.offset += len(payload)
+
+    def metrics(self):
+        return {'datagrams': self.sequence, 'dropped': self.dropped}
+
+
+class CommandScheduler(object):
+    '''
+    Sits between command_allowed() and rtl_tcp, so that a burst of commands (e.g. while someone drags the
+    waterfall) makes the tuner retune only a few times:
+        - pending commands of the same id are coalesced, only the newest value is sent,
+        - commands that would not change the state of the tuner are skipped,
+        - commands are sent in batches at most every command_min_interval seconds,
+        - a client may have client_command_rate commands per second sent (with bursts of client_command_burst),
+          the ones above that wait (and are coalesced) until it may have one again, unless another client
+          sets the same meanwhile: the newer command wins.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = collections.OrderedDict()  # command id -> command, in the order to send them
+        self.held = {}  # client -> its commands waiting for its rate limit, like pending
+        self.buckets = {}  # client -> (tokens, time) of its rate limit
+        self.last_flush = None
+        self.flush_handle = None
+
+    def submit(self, client, command):
+        self.supersede(client, command[0])
+        if self.is_current(command) and client not in self.held:
+            METRICS.commands[command[0], 'skipped'] += 1
+            LOGGER.debug("not forwarding command %d of %s, the tuner has this setting already", command[0], client)
+            return
+        if self.server.config.client_command_rate:
+            if client in self.held:
+                self.coalesce(self.held[client], command)
+                return
+            wait = self.take_token(client)
+            if wait:
+                LOGGER.debug("rate limit: holding command %d of %s for %.2f s", command[0], client, wait)
+                self.held[client] = collections.OrderedDict(((command[0], command),))
+                LOOP.call_later(wait, self.release, client)
+                return
+        self.coalesce(self.pending, command)
+        self.schedule_flush()
+
+    def release(self, client):
+        held = self.held.pop(client, None)
+        if held is None:  # the client is gone
+            return
+        self.take_token(client)
+        for command in held.values():
+            self.coalesce(self.pending, command)
+        self.schedule_flush()
+
+    def supersede(self, client, command_id):
+        # the held commands of the other clients with this id are older, sent later they would override it
+        for other, held in self.held.items():
+            if other is not client and held.pop(command_id, None) is not None:
+                METRICS.commands[command_id, 'coalesced'] += 1
+
+    def take_token(self, client):
+        # token bucket, returns 0 if the client may have a command sent now, or the seconds to wait otherwise
+        now = LOOP.time()
+        tokens, last = self.buckets.get(client, (self.server.config.client_command_burst, now))
+        tokens = min(self.server.config.client_command_burst, tokens + (now - last) * self.server.config.client_command_rate)
+        if tokens >= 1:
+            self.buckets[client] = (tokens - 1, now)
+            return 0
+        self.buckets[client] = (tokens, now)
+        return (1 - tokens) / self.server.config.client_command_rate
+
+    def is_current(self, command):
+        # the tuner has (or will have, after the pending commands) this setting
+        current = self.pending.get(command[0])
+        if current is None:
+            current = self.server.rtl_tcp.state.commands.get(command[0])
+        return current == command
+
+    def coalesce(self, commands, command):
+        if commands.pop(command[0], None) is not None:
+            METRICS.commands[command[0], 'coalesced'] += 1
+        if commands is self.pending and self.server.rtl_tcp.state.commands.get(command[0]) == command:
+            METRICS.commands[command[0], 'skipped'] += 1  # it is back to the current setting
+            return
+        commands[command[0]] = command
 
+    def schedule_flush(self):
+        if self.flush_handle is not None or not self.pending:
+            return
+        delay = 0 if self.last_flush is None else self.last_flush + self.server.config.command_min_interval - LOOP.time()
+        if delay > 0:
+            self.flush_handle = LOOP.call_later(delay, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        self.flush_handle = None
+        self.last_flush = LOOP.time()
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for command in pending.values():
+            METRICS.commands[command[0], 'forwarded'] += 1
+        self.server.rtl_tcp.forward_commands(list(pending.values()))
+
+    def forget(self, client):
+        self.held.pop(client, None)
+        self.buckets.pop(client, None)
+
+
+class ControlSocket(object):
+    '''
+    One end of the control socket between the main process and a sender worker, for sending. It never blocks
+    the event loop: what the other end cannot take right now waits in a queue, in order, and is sent as soon
+    as it can be. drained() is called when the queue is empty again.
+    '''
+
+    def __init__(self, sock, drained=None):
+        sock.setblocking(False)
+        self.sock = sock
+        self.drained = drained
+        self.queue = collections.deque()  # (message, socket passed along or None)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message, passed=None):
+        # passed is a socket to pass along with the message (SCM_RIGHTS), which is closed once it is
+        if not self.queue:
+            try:
+                self.send_now(message, passed)
+                return
+            except BlockingIOError:
+                LOOP.add_writer(self.sock.fileno(), self.flush)
+            except OSError:  # the other end is gone, its reader finds out
+                if passed is not None:
+                    passed.close()
+                return
+        self.queue.append((message, passed))
+
+    def send_now(self, message, passed):
+        if passed is None:
+            self.sock.send(message)
+        else:
+            socket.send_fds(self.sock, [message], [passed.fileno()])
+            passed.close()
+
+    def flush(self):
+        while self.queue:
+            message, passed = self.queue[0]
+            try:
+                self.send_now(message, passed)
+            except BlockingIOError:
+                return
+            except OSError:
+                for message, passed in self.queue:
+                    if passed is not None:
+                        passed.close()
+                self.queue.clear()
+                break
+            self.queue.popleft()
+        LOOP.remove_writer(self.sock.fileno())
+        if self.drained is not None:
+            self.drained()
+
+
+class SenderWorker(object):
+    '''
+    Handle of a sender worker process, as the main process sees it.
+    The worker gets accepted client sockets passed over a unix socket (SCM_RIGHTS), and sends them
+    the I/Q data from the shared ring. Commands of its clients come back here for command_allowed().
+    Control messages (one per datagram, on non-blocking sockets, see ControlSocket):
+        main -> worker: C<ident><compression><preroll> + client fd, I<dongle identifier>, R<sample rate of the ring>
+        worker -> main: X<ident><command>, Z<ident><compression> (set by the client), Q<ident> (client disconnected), S<metrics as JSON> (every second,
+                        in several messages: the commands and timings, then the clients in batches)
+    New data in the rings is signalled on a separate non-blocking pipe, so that it never blocks the main process.
+    Each wakeup carries the heads of the rings: the write to the pipe comes after the data is in place, and the
+    worker's read of it before it reads the data, so they also order the two on weakly ordered CPUs (e.g. ARM).
+    '''
+
+    def __init__(self, config, index, ring, streams, workers, memory_budget):
+        self.index = index
+        self.server = None  # the Server of its upstream, which sets this
+        self.clients = {}
+        self.commands = collections.Counter()  # the local commands of its clients, as last reported
+        self.timings = {}  # its TIMINGS, as last reported
+        self.rings = [ring] + [stream.ring for stream in streams.values()]
+        self.heads = struct.Struct('<%dQ' % len(self.rings))
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.control = ControlSocket(control)
+        worker_notify, self.notify = os.pipe()
+        os.set_blocking(self.notify, False)
+        # the worker must not keep the main process' end of its own and the earlier workers' sockets open (of all upstreams), or they never see it exit
+        inherited = [fd for worker in workers + [self] for fd in (worker.control.fileno(), worker.notify)]
+        self.process = multiprocessing.get_context('fork').Process(target=sender_worker, args=(config, index, worker_control, worker_notify, ring, streams, inherited, memory_budget))
+        self.process.daemon = True
+        self.process.start()
+        worker_control.close()
+        os.close(worker_notify)
+        LOOP.add_reader(self.control.fileno(), self.handle_control)
+
+    def add_client(self, client, sock, compression, preroll):
+        self.clients[client.ident] = client
+        self.control.send(b'C' + struct.pack('>IBI', client.ident, compression, preroll), sock)
+
+    def send_identifier(self, identifier):
+        self.control.send(b'I' + identifier)
+
+    def send_sample_rate(self, rate):
+        self.control.send(b'R' + struct.pack('>I', rate))
+
+    def wake(self):
+        try:
+            os.write(self.notify, self.heads.pack(*[ring.head for ring in self.rings]))
+        except BlockingIOError:
+            pass  # the worker has unread wakeups anyway, the next one publishes the newer heads
 
-rtl_tcp_resetting = False  # put me away
+    def handle_control(self):
+        try:
+            message = self.control.sock.recv(1 << 20)
+        except BlockingIOError:
+            return
+        if not message:
+            LOGGER.error("sender worker %d has exited, dropping its %d clients", self.index, len(self.clients))
+            LOOP.remove_reader(self.control.fileno())
+            for client in list(self.clients.values()):
+                self.server.remove_client(client)
+            self.clients.clear()
+            return
+        if message[:1] == b'S':
+            self.update_metrics(json.loads(message[1:].decode()))
+            return
+        kind, ident = message[:1], struct.unpack('>I', message[1:5])[0]
+        client = self.clients.get(ident)
+        if client is None:
+            return
+        if kind == b'X':
+            self.server.handle_command(client, bytearray(message[5:10]))
+        elif kind == b'Z':
+            previous, client.compression = client.compression, message[5]
+            self.server.compression_changed(client, previous)
+        elif kind == b'Q':
+            del self.clients[ident]
+            self.server.remove_client(client)  # the worker has logged it already
+
+    def update_metrics(self, report):
+        # one of the messages of a report: the commands and timings, or a batch of clients
+        for stats in report.get('clients', ()):
+            client = self.clients.get(stats['ident'])
+            if client is not None:
+                client.stats = stats
+        if 'commands' in report:
+            self.commands = collections.Counter(dict(((command_id, result), count) for command_id, result, count in report['commands']))
+            self.timings = report['timings']
+
+
+class WorkerServer(object):
+    '''Server of a sender worker process: serves the clients passed to it from the shared ring.'''
+
+    workers = ()
+    rtl_tcp = None
+    max_backlog = 64  # control messages waiting for the main process before clients sending commands are paused
+    report_clients = 100  # clients per metrics message, as a datagram cannot be larger than the socket buffer
+
+    def __init__(self, config, control, notify, ring, streams):
+        self.clients = frozenset()  # copy-on-write, like Server.clients
+        self.config = config
+        self.ring_sample_rate = config.initial_sample_rate  # until the main process sends it
+        self.control = ControlSocket(control, self.resume_commands)
+        self.paused_clients = set()  # they sent commands faster than the main process takes them
+        self.notify = notify
+        self.ring = ring
+        self.streams = streams
+        self.rings = [ring] + [stream.ring for stream in streams.values()]
+        self.heads = struct.Struct('<%dQ' % len(self.rings))
+        for ring in self.rings:
+            ring.reader_head = ring.head_view[0]  # everything written before the fork is in place
+        self.dongle_identifier = b''
+        self.latency = LatencyStats("%s sender worker %d" % (config.name, os.getpid()))
+        if config.latency_log_interval:
+            LOOP.call_later(config.latency_log_interval, self.latency.log)
+        LOOP.add_reader(control.fileno(), self.handle_control)
+        LOOP.add_reader(notify, self.wake_clients)
+        LOOP.call_later(Metrics.interval, self.report_metrics)
+
+    def handle_control(self):
+        try:
+            message, fds, flags, addr = socket.recv_fds(self.control.sock, 4096, 1)
+        except BlockingIOError:
+            return
+        if not message:  # the main process is gone
+            LOOP.stop()
+            return
+        if message[:1] == b'C':
+            ident, compression, preroll = struct.unpack('>IBI', message[1:10])
+            LOOP.create_task(self.accept_client(socket.socket(fileno=fds[0]), ident, compression, preroll))
+        elif message[:1] == b'I':
+            self.dongle_identifier = message[1:]
+            self.wake_clients()
+        elif message[:1] == b'R':
+            self.ring_sample_rate = struct.unpack('>I', message[1:5])[0]
+
+    async def accept_client(self, sock, ident, compression, preroll):
+        def create_client():
+            client = Client(self, compression, preroll)
+            client.ident = ident
+            return client
+        await LOOP.connect_accepted_socket(create_client, sock)
+
+    def add_client(self, client):
+        self.clients = self.clients | {client}
 
+    def remove_client(self, client):
+        self.clients = self.clients - {client}
+        self.paused_clients.discard(client)
+        self.control.send(b'Q' + struct.pack('>I', client.ident))
+
+    def compression_changed(self, client, previous):
+        # the main process encodes the compressed streams, and only the ones with clients
+        self.control.send(b'Z' + struct.pack('>IB', client.ident, client.compression))
+
+    def handle_command(self, client, command):
+        self.control.send(b'X' + struct.pack('>I', client.ident) + bytes(command))
+        if len(self.control.queue) > self.max_backlog and client not in self.paused_clients:
+            # read no more commands of it until the main process has taken the ones waiting
+            client.transport.pause_reading()
+            self.paused_clients.add(client)
+
+    def resume_commands(self):
+        for client in self.paused_clients:
+            if not client.transport.is_closing():
+                client.transport.resume_reading()
+        self.paused_clients.clear()
+
+    def wake_clients(self):
+        try:
+            # whole wakeups only, as each is written at once (atomically, it is smaller than PIPE_BUF)
+            wakeups = os.read(self.notify, self.heads.size * max(1, 4096 // self.heads.size))
+        except BlockingIOError:
+            wakeups = b''
+        if wakeups:
+            for ring, head in zip(self.rings, self.heads.unpack_from(wakeups, len(wakeups) - self.heads.size)):
+                ring.reader_head = head
+        for client in self.clients:
+            client.pump()
 
-def rtl_tcp_asyncore_reset(timeout):
-    global RTL_TCP
-    global rtl_tcp_resetting
-    if rtl_tcp_resetting:
-        return
-    # print("rtl_tcp_asyncore_reset")
-    rtl_tcp_resetting = True
-    time.sleep(timeout)
-    data = RTL_TCP.__dict__
-    try:
-        RTL_TCP.close()
-    except Exception:
-        pass
-    try:
-        del RTL_TCP
-    except Exception:
-        pass
-    RTL_TCP = RtlTcpAsyncore(data['server_missing_logged'], data['commands'], data['dsp_input_queue'])
-    # print(asyncore.socket_map)
-    rtl_tcp_resetting = False
-
-
-class RtlTcpAsyncore(asyncore.dispatcher):
-    def __init__(self, server_missing_logged, commands, dsp_input_queue):
-        asyncore.dispatcher.__init__(self)
-        self.ok = True
-        self.dongle_identifier = b''  # rtl_tcp sends some identifier on dongle type and gain values in the first few bytes right after connection
-        self.server_missing_logged = server_missing_logged  # Not to flood the screen with messages related to rtl_tcp disconnect
-        self.commands = commands
-        self.dsp_input_queue = dsp_input_queue
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    def report_metrics(self):
         try:
-            self.connect((CONFIG.rtl_tcp_host, CONFIG.rtl_tcp_port))
-            self.socket.settimeout(0.1)
-        except Exception:
-            LOGGER.error("rtl_tcp connection refused. Retrying.")
-            thread.start_new_thread(rtl_tcp_asyncore_reset, (1,))
-            self.close()
+            if self.control.queue:
+                return  # the main process is behind, the next report is as good
+            self.control.send(b'S' + json.dumps({
+                'commands': [[command_id, result, count] for (command_id, result), count in METRICS.commands.items()],
+                'timings': dict((name, histogram.snapshot()) for name, histogram in TIMINGS.items()),
+            }).encode())
+            clients = [client.metrics() for client in self.clients]
+            for start in range(0, len(clients), self.report_clients):
+                self.control.send(b'S' + json.dumps({'clients': clients[start:start + self.report_clients]}).encode())
+        finally:
+            LOOP.call_later(Metrics.interval, self.report_metrics)
+
+
+def sender_worker(config, index, control, notify, ring, streams, inherited, memory_budget):
+    global LOOP, SERVERS, METRICS, IP_ACCESS
+    IP_ACCESS = None
+    for fd in inherited:
+        os.close(fd)
+    os.set_blocking(notify, False)
+    LOOP = new_event_loop()
+    METRICS = Metrics()  # only the clients of this worker
+    SERVERS = [WorkerServer(config, control, notify, ring, streams)]
+    METRICS.start()
+    LOOP.add_signal_handler(signal.SIGUSR1, toggle_profiler)
+    if memory_budget:
+        LOOP.call_later(memory_check_interval, enforce_memory_budget, memory_budget)
+    LOGGER.info("%s: sender worker %d started", config.name, index)
+    LOOP.run_forever()
+
+
+class TunerState(object):
+    '''
+    What rtl_mus knows about its upstream: the dongle identifier, and the last value of every
+    command forwarded to it, which is replayed after reconnecting. In relay mode the dongle identifier
+    survives reconnections too, and both are kept in relay_state_file if that is set, so that they
+    survive restarts.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.dongle_identifier = b''
+        self.commands = {}  # command id -> the whole command, in the order to replay them
+        if self.config.relay_mode and self.config.relay_state_file and os.path.exists(self.config.relay_state_file):
+            try:
+                with open(self.config.relay_state_file) as f:
+                    state = json.load(f)
+                self.dongle_identifier = bytes.fromhex(state['dongle_identifier'])
+                self.commands = dict((int(command_id), bytes.fromhex(command)) for command_id, command in state['commands'].items())
+            except (IOError, ValueError, KeyError) as exc:
+                LOGGER.error("cannot load relay_state_file: %s", exc)
+
+    def update(self, command):
+        self.commands.pop(command[0], None)  # e.g. a gain set after the gain mode must be replayed after it too
+        self.commands[command[0]] = command
+
+    def snapshot(self):
+        # for the state endpoint: the settings by name, and the raw commands
+        state = {}
+        if len(self.dongle_identifier) == 12:
+            magic, tuner, gain_count = struct.unpack('>4sII', self.dongle_identifier)
+            state.update(dongle_identifier=self.dongle_identifier.hex(), tuner=TUNER_TYPES.get(tuner, tuner), gain_count=gain_count)
+        for command_id, command in self.commands.items():
+            state[COMMAND_NAMES.get(command_id, str(command_id))] = struct.unpack('>I', command[1:5])[0]
+        state['commands'] = [command.hex() for command in self.commands.values()]
+        return state
+
+    def save(self):
+        if not self.config.relay_state_file:
             return
-
-    def handle_error(self):
-        global rtl_tcp_connected
-        rtl_tcp_connected = False
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        self.ok = False
-        server_is_missing = hasattr(exc_value, "errno") and exc_value.errno == 111
-        if (not server_is_missing) or (not self.server_missing_logged):
-            LOGGER.exception(exc_value)
-            self.server_missing_logged |= server_is_missing
+        state = {'dongle_identifier': self.dongle_identifier.hex(), 'commands': dict((command_id, command.hex()) for command_id, command in self.commands.items())}
         try:
-            self.close()
-        except Exception:
-            pass
-        thread.start_new_thread(rtl_tcp_asyncore_reset, (2,))
-
-    def handle_connect(self):
-        global rtl_tcp_connected
-        self.socket.settimeout(0.1)
-        rtl_tcp_connected = True
-        if self.ok:
-            LOGGER.info("rtl_tcp host connection estabilished")
-            self.server_missing_logged = False
-            self.commands.put(b'\x02' + struct.pack('>I', sample_rate)) #send the initial sample_rate
-
-    def handle_close(self):
-        global rtl_tcp_connected
-        rtl_tcp_connected = False
-        LOGGER.error("rtl_tcp host connection has closed, now trying to reopen")
+            with open(self.config.relay_state_file, 'w') as f:
+                json.dump(state, f)
+        except IOError as exc:
+            LOGGER.error("cannot save relay_state_file: %s", exc)
+
+
+class RtlTcp(object):
+    '''
+    The upstream rtl_tcp, a reconnecting state machine run by the event loop:
+    connecting -> connected -> (closed, failed, or sending nothing) -> waiting -> connecting -> ...
+    It waits reconnect_min_delay seconds before the first attempt to reconnect, twice as long before
+    every next one up to reconnect_interval, with jitter. A connection that sends nothing for
+    watchdog_interval seconds is dropped, and the clients get null samples until the data is back.
+    '''
+
+    reconnect_min_delay = 0.1
+    connect_timeout = 5
+
+    def __init__(self, server, dsp, state):
+        self.server = server
+        self.config = server.config
+        self.dsp = dsp
+        self.state = state
+        self.null_fill = NullFill(self)
+        self.commands = collections.deque()  # waiting to be sent to rtl_tcp
+        self.connection = None  # the RtlTcpConnection while connected
+        self.status = 'waiting'
+        self.failures = 0  # attempts to reconnect since the last data received
+        self.server_missing_logged = False  # Not to flood the screen with messages related to rtl_tcp disconnect
+        self.timer = None  # the reconnect timer while waiting, the stall timer while connected
+        self.last_read = 0.0
+        # metrics
+        self.received_bytes = 0
+        self.reconnects = 0
+        self.last_received_bytes = 0
+        self.rate = 0
+        self.last_dsp_bytes = (0, 0)
+        self.dsp_rates = (0, 0)
+        self.connect()
+
+    def connect(self):
+        self.status = 'connecting'
+        self.timer = None
+        LOOP.create_task(self.open_connection())
+
+    async def open_connection(self):
         try:
-            self.close()
-        except Exception:
-            pass
-        thread.start_new_thread(rtl_tcp_asyncore_reset, (2,))
-
-    def handle_read(self):
-        global watchdog_data_count
-        if not self.dongle_identifier:
-            self.dongle_identifier = self.recv(12)
+            await asyncio.wait_for(LOOP.create_connection(lambda: RtlTcpConnection(self), self.config.rtl_tcp_host, self.config.rtl_tcp_port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            server_is_missing = getattr(exc, 'errno', None) == errno.ECONNREFUSED
+            if (not server_is_missing) or (not self.server_missing_logged):
+                LOGGER.error("%s: rtl_tcp connection error: %s", self.config.name, str(exc) or "timed out")
+                self.server_missing_logged |= server_is_missing
+            self.disconnected()
+
+    def connection_made(self, connection):
+        self.status = 'connected'
+        self.connection = connection
+        LOGGER.info("%s: rtl_tcp host connection estabilished", self.config.name)
+        self.server_missing_logged = False
+        if not self.config.relay_mode:
+            # rtl_tcp sends some identifier on dongle type and gain values in the first few bytes right after connection
+            self.state.dongle_identifier = b''
+        commands = []
+        if connection.decoder is not None:  # the upstream is another rtl_mus, ask for the compressed stream
+            commands.append(struct.pack('>BI', SET_COMPRESSION, connection.decoder.codec.codec_id))
+        if 2 not in self.state.commands:  # the initial sample_rate
+            self.state.commands[2] = b'\x02' + struct.pack('>I', self.server.sample_rate)
+        # the upstream may have been restarted with its defaults, so restore the whole tuner state at once
+        # (this includes whatever was forwarded while disconnected)
+        self.commands.clear()
+        commands.extend(self.state.commands.values())
+        self.queue_commands(commands)
+        if self.dsp is not None:
+            self.dsp.reset()
+        if self.config.watchdog_interval:
+            self.last_read = LOOP.time()
+            self.timer = LOOP.call_at(self.last_read + self.config.watchdog_interval, self.check_stall)
+
+    def connection_lost(self, connection):
+        if connection is not self.connection:  # already dropped
             return
-        new_data_buffer = self.recv(16348)
-        if CONFIG.watchdog_interval:
-            watchdog_data_count += 16348
-        if self.dsp_input_queue is not None:
-            self.dsp_input_queue.put(new_data_buffer)
-            # print("did put anyway")
+        LOGGER.error("%s: rtl_tcp host connection has closed, now trying to reopen", self.config.name)
+        self.disconnected()
+
+    def check_stall(self):
+        # the stall timer: re-armed lazily from the time of the last read, so that reading costs no timer
+        deadline = self.last_read + self.config.watchdog_interval
+        if LOOP.time() < deadline:
+            self.timer = LOOP.call_at(deadline, self.check_stall)
+            return
+        decoder = self.connection.decoder
+        if decoder is not None and decoder.skipped:
+            LOGGER.error("%s: watchdog: no compressed frame from the upstream for %g s, %d bytes skipped (does it have %s in compression_codecs, and lets clients set it?), "
+                         "restarting rtl_tcp connection now.", self.config.name, self.config.watchdog_interval, decoder.skipped, self.config.rtl_tcp_compression)
         else:
-            SERVER.add_data_to_clients(new_data_buffer)
-
-    def writable(self):
-        # check if any new commands to write
-        return not RTL_TCP.commands.empty()
-
-    def handle_write(self):
-        while not RTL_TCP.commands.empty():
-            mcmd = RTL_TCP.commands.get()
-            self.send(mcmd)
-
-
-def watchdog_thread():
-    global rtl_tcp_connected
-    global watchdog_data_count
-    zero_buffer_size = 16348
-    second_frac = 10
-    zero_buffer = b'\x7f' * zero_buffer_size
-    watchdog_data_count = 0
-    rtl_tcp_connected = False
-    null_fill = False
-    time.sleep(4)  # wait before activating this thread
-    LOGGER.info("watchdog started")
-    first_start = True
-    n = 0
-    while True:
-        wait_altogether = CONFIG.watchdog_interval if rtl_tcp_connected or first_start else CONFIG.reconnect_interval
-        first_start = False
-        if null_fill:
-            LOGGER.error("watchdog: filling buffer with zeros.")
-            while wait_altogether > 0:
-                wait_altogether -= 1.0 / second_frac
-                for i in range((2 * sample_rate) // (second_frac * zero_buffer_size)):
-                    SERVER.add_data_to_clients(zero_buffer)
-                    n += len(zero_buffer)
-                    time.sleep(0)  # yield
-                    if watchdog_data_count:
-                        break
-                if watchdog_data_count:
-                    break
-                time.sleep(1.0 / second_frac)
-                # print("sent altogether",n)
+            LOGGER.error("%s: watchdog: no data from rtl_tcp for %g s, restarting rtl_tcp connection now.", self.config.name, self.config.watchdog_interval)
+        self.timer = None
+        self.connection.transport.abort()
+        self.disconnected()
+
+    def disconnected(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.connection = None
+        self.status = 'waiting'
+        if self.config.watchdog_interval:
+            self.null_fill.start()
+        delay = min(self.reconnect_min_delay * 2 ** self.failures, self.config.reconnect_interval)
+        self.failures += 1
+        self.reconnects += 1
+        self.timer = LOOP.call_later(random.uniform(delay / 2, delay), self.connect)
+
+    def samples_received(self, data):
+        # whole I/Q samples from the connection
+        self.failures = 0
+        if self.config.watchdog_interval:
+            self.null_fill.stop()  # the filler has only ever sent whole samples, so the live data goes on right after it
+        self.feed(data)
+
+    def feed(self, data):
+        if self.dsp is not None:
+            self.dsp.feed(data)
         else:
-            time.sleep(wait_altogether)
-        null_fill = not watchdog_data_count
-        if not watchdog_data_count:
-            LOGGER.error("watchdog: restarting rtl_tcp_asyncore() now.")
-            rtl_tcp_asyncore_reset(0)
-        watchdog_data_count = 0
+            self.server.add_data_to_clients(data)  # in the event loop thread already
+
+    def forward_commands(self, commands):
+        # commands of clients, allowed by command_allowed() and passed on by the CommandScheduler
+        for command in commands:
+            self.state.update(command)
+        if self.config.relay_mode:
+            self.state.save()
+        self.queue_commands(commands)
+
+    def sample(self, elapsed):
+        self.rate = int((self.received_bytes - self.last_received_bytes) / elapsed)
+        self.last_received_bytes = self.received_bytes
+        if self.dsp is not None:
+            dsp_bytes = (self.dsp.input_bytes, self.dsp.output_bytes)
+            self.dsp_rates = tuple(int((new - old) / elapsed) for new, old in zip(dsp_bytes, self.last_dsp_bytes))
+            self.last_dsp_bytes = dsp_bytes
+
+    def metrics(self):
+        return {
+            'name': self.config.name, 'connected': self.status == 'connected',
+            'received_bytes': self.received_bytes, 'rate': self.rate, 'reconnects': self.reconnects,
+            'multicast': None if self.server.multicast is None else self.server.multicast.metrics(),
+            'recorder': None if self.server.recorder is None else self.server.recorder.metrics(),
+            'dsp': None if self.dsp is None else {
+                'input_bytes': self.dsp.input_bytes, 'input_rate': self.dsp_rates[0],
+                'output_bytes': self.dsp.output_bytes, 'output_rate': self.dsp_rates[1], 'errors': self.dsp.errors,
+            },
+        }
+
+    def queue_commands(self, commands):
+        self.commands.extend(commands)
+        if self.commands and self.connection is not None and not self.connection.transport.is_closing():
+            self.connection.transport.write(b''.join(self.commands))  # one batch
+            self.commands.clear()
+
+
+class RtlTcpConnection(asyncio.Protocol):
+    '''One connection to rtl_tcp, RtlTcp decides what to do when it ends.'''
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.transport = None
+        self.header_received = False
+        self.identifier_buffer = b''
+        self.odd_byte = b''
+        compression = upstream.config.rtl_tcp_compression
+        self.decoder = FrameDecoder(frame_codec_id(compression)) if compression else None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.upstream.connection_made(self)
+
+    def connection_lost(self, exc):
+        self.upstream.connection_lost(self)
+
+    def data_received(self, data):
+        self.upstream.received_bytes += len(data)
+        if self.decoder is None:
+            self.upstream.last_read = LOOP.time()
+        state = self.upstream.state
+        if not self.header_received:
+            self.identifier_buffer += data
+            if len(self.identifier_buffer) < 12:
+                return
+            self.header_received = True
+            identifier, data = self.identifier_buffer[:12], self.identifier_buffer[12:]
+            if identifier != state.dongle_identifier:
+                if state.dongle_identifier:
+                    LOGGER.info("%s: the dongle identifier of the upstream has changed", self.upstream.config.name)
+                state.dongle_identifier = identifier
+                if self.upstream.config.relay_mode:
+                    state.save()
+                self.upstream.server.wake()  # clients may be waiting for it
+            if not data:
+                return
+        if self.decoder is not None:
+            data = self.decoder.feed(data)
+            if self.decoder.skipped > self.decoder.max_skipped:
+                LOGGER.error("%s: no compressed frame in %d bytes from the upstream (does it have %s in compression_codecs, and lets clients set it?), reconnecting",
+                             self.upstream.config.name, self.decoder.skipped, self.upstream.config.rtl_tcp_compression)
+                self.transport.abort()
+                return
+            if not data:
+                return
+            self.upstream.last_read = LOOP.time()  # only decoded frames count, or an upstream sending no frames would never stall
+        if self.odd_byte:
+            data = self.odd_byte + data
+            self.odd_byte = b''
+        if len(data) % 2:
+            # keep the I/Q samples whole, so that every chunk boundary in the ring starts with I
+            data, self.odd_byte = data[:-1], data[-1:]
+            if not data:
+                return
+        self.upstream.samples_received(data)
+
+
+class MulticastUpstream(RtlTcp):
+    '''
+    Receives the I/Q stream published by another rtl_mus (multicast_group) instead of connecting to
+    rtl_tcp, and serves it to its clients like any other stream, as rtl_tcp would. Lost datagrams are
+    replaced by null samples, so the stream keeps its timing. The multicast is one-way: the commands
+    of the clients are kept in the tuner state, but cannot be sent to the dongle.
+    '''
+
+    def __init__(self, server, dsp, state):
+        self.filled_bytes = 0  # of lost datagrams
+        self.late_datagrams = 0
+        RtlTcp.__init__(self, server, dsp, state)
+
+    async def open_connection(self):
+        group, port = self.config.multicast_upstream.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind((group, int(port)))  # only the datagrams of this group
+            membership = socket.inet_aton(group) + socket.inet_aton(self.config.multicast_interface or '0.0.0.0')
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            await LOOP.create_datagram_endpoint(lambda: MulticastConnection(self), sock=sock)
+        except OSError as exc:
+            LOGGER.error("%s: cannot receive multicast %s: %s", self.config.name, self.config.multicast_upstream, exc)
+            sock.close()
+            self.disconnected()
+            return
+        LOGGER.info("%s: receiving multicast %s", self.config.name, self.config.multicast_upstream)
 
+    def queue_commands(self, commands):
+        self.commands.clear()
 
-def main():
-    global RTL_TCP, SERVER
-    global sample_rate
+    def metrics(self):
+        metrics = RtlTcp.metrics(self)
+        metrics.update(filled_bytes=self.filled_bytes, late_datagrams=self.late_datagrams)
+        return metrics
 
-    setup_logging()
-    LOGGER.info("Server is UP")
 
-    if not CONFIG.denied_ip_ranges:
-        CONFIG.denied_ip_ranges = ('0.0.0.0/0',)
-    if not CONFIG.allowed_ip_ranges:
-        CONFIG.allowed_ip_ranges = ('0.0.0.0/0',)
-    assert isinstance(CONFIG.denied_ip_ranges, tuple), 'Make sure denied_ip_ranges is a tuple'
-    assert isinstance(CONFIG.allowed_ip_ranges, tuple), 'Make sure allowed_ip_ranges is a tuple'
-    CONFIG.denied_ip_ranges = [ip_network(ip_range) for ip_range in CONFIG.denied_ip_ranges]
-    CONFIG.allowed_ip_ranges = [ip_network(ip_range) for ip_range in CONFIG.allowed_ip_ranges]
-
-    sample_rate = CONFIG.initial_sample_rate
-
-    # start dsp threads
-    if CONFIG.use_dsp_command:
-        dsp_input_queue = multiprocessing.Queue()
-        start_dsp(dsp_input_queue)
-    else:
-        dsp_input_queue = None
+class MulticastConnection(asyncio.DatagramProtocol):
+    '''The multicast socket of a MulticastUpstream: puts the datagrams back in order by their offset.'''
+
+    max_gap = 4 * 1024 * 1024  # bytes: a larger jump of the offset means that the sender has restarted
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.transport = None
+        self.decoder = None
+        self.offset = None  # of the next byte expected
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.upstream.connection_made(self)
+
+    def connection_lost(self, exc):
+        self.upstream.connection_lost(self)
+
+    def datagram_received(self, datagram, addr):
+        if len(datagram) < MULTICAST_HEADER.size or datagram[:4] != MULTICAST_MAGIC:
+            return
+        magic, sequence, offset, identifier = MULTICAST_HEADER.unpack_from(datagram)
+        upstream = self.upstream
+        upstream.received_bytes += len(datagram)
+        upstream.last_read = LOOP.time()
+        if identifier != upstream.state.dongle_identifier and identifier.strip(b'\0'):
+            upstream.state.dongle_identifier = identifier
+            upstream.server.wake()  # clients may be waiting for it
+        payload = memoryview(datagram)[MULTICAST_HEADER.size:]
+        if self.offset is not None and offset != self.offset:
+            if offset < self.offset and self.offset - offset < self.max_gap:
+                upstream.late_datagrams += 1  # filled already
+                return
+            if offset > self.offset and offset - self.offset < self.max_gap:
+                gap = offset - self.offset
+                upstream.filled_bytes += gap
+                while gap:
+                    fill = NullFill.chunk[:min(gap, len(NullFill.chunk))]
+                    gap -= len(fill)
+                    upstream.samples_received(fill)
+            else:
+                LOGGER.info("%s: the multicast stream has restarted", upstream.config.name)
+        self.offset = offset + len(payload)
+        if payload:
+            upstream.samples_received(payload)
+
+
+class NullFill(object):
+    '''
+    Fills the stream with null samples while the upstream sends nothing, so that the clients
+    (e.g. GNU Radio in openwebrx) do not hang. It is paced by event loop timers: every tick it sends
+    the samples due at sample_rate since the last one, so it neither drifts nor bursts, and it stops
+    as soon as the upstream sends data again. It always sends whole I/Q samples.
+    '''
+
+    tick = 0.02  # seconds between two chunks of null samples
+    max_catch_up = 0.25  # seconds of samples sent at most after the event loop has been held up
+    chunk = memoryview(b'\x7f' * 65536)  # preallocated, sent in slices
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.handle = None
+
+    def start(self):
+        if self.handle is not None:
+            return
+        LOGGER.error("%s: watchdog: filling buffer with zeros.", self.upstream.config.name)
+        self.last = LOOP.time()
+        self.due = 0.0  # samples due but not sent yet (the fraction of one)
+        self.handle = LOOP.call_later(self.tick, self.fill)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def fill(self):
+        now = LOOP.time()
+        sample_rate = self.upstream.server.sample_rate
+        self.due = min(self.due + (now - self.last) * sample_rate, self.max_catch_up * sample_rate)
+        self.last = now
+        samples = int(self.due)
+        self.due -= samples
+        length = 2 * samples
+        while length:
+            data = self.chunk[:min(length, len(self.chunk))]
+            length -= len(data)
+            self.upstream.feed(data)
+        self.handle = LOOP.call_later(self.tick, self.fill)
+
+
+class Recorder(object):
+    '''
+    Records the I/Q stream of a Server to disk (record_path), while it goes on serving its clients.
+    It reads the ring like a client does, with a cursor of its own, but in a thread of its own, so that a
+    slow disk never holds up the event loop: if it falls more than the ring behind, it skips ahead like
+    a slow client and counts the drop, the clients do not wait for it.
+    The stream goes into segment files of record_segment_size bytes, preallocated and written through mmap.
+    Next to each <name>.iq there is a <name>.idx, with one JSON line every record_index_interval seconds (and
+    after a drop or a change of the sample rate): time (Unix time of the byte at offset), offset, sample_rate.
+    A finished segment is truncated to its data; of an interrupted one, the last index line tells its length.
+    Only the newest record_segments segments are kept. On shutdown, close() finishes the segment being written.
+    '''
+
+    tick = 0.05  # seconds between two looks at the ring
+
+    def __init__(self, server):
+        self.server = server
+        self.config = server.config
+        self.ring = server.ring
+        self.cursor = self.ring.head
+        self.size = self.config.record_segment_size & ~1  # whole I/Q samples in every segment
+        self.prefix = '%s-%s-' % (self.config.name, time.strftime('%Y%m%d-%H%M%S'))
+        self.sequence = 0
+        self.segment = None  # (path, fd, mmap, index file) of the segment being written
+        self.next_segment = None  # preallocated ahead
+        self.offset = 0  # in the segment
+        self.index_time = None
+        self.index_sample_rate = None
+        self.index_identifier = None
+        # metrics, changed by the recorder thread only
+        self.recorded_bytes = 0
+        self.drops = 0
+        self.dropped_bytes = 0
+        self.segments = 0
+        self.errors = 0
+        self.closing = False
+        self.closed = threading.Event()
+        os.makedirs(self.config.record_path, exist_ok=True)
+        LOGGER.info("%s: recording to %s", self.config.name, self.config.record_path)
+        thread.start_new_thread(self.record_thread, ())
+
+    def close(self, timeout=5.0):
+        # the recorder thread finishes the segment itself, between two writes
+        self.closing = True
+        self.closed.wait(timeout)
+
+    def record_thread(self):
+        while not self.closing:
+            time.sleep(self.tick)
+            try:
+                self.record()
+            except (OSError, ValueError) as exc:  # e.g. the disk is full
+                self.errors += 1
+                LOGGER.error("%s: recording: %s", self.config.name, exc)
+                self.close_segment()
+                time.sleep(1)
+                self.cursor = self.ring.head
+        self.close_segment()
+        self.remove_segment(self.next_segment)  # preallocated, but not written to
+        self.next_segment = None
+        self.closed.set()
+
+    def record(self):
+        if self.segment is None:
+            self.start_segment()
+        while True:
+            head = self.ring.head
+            lag = head - self.cursor
+            if lag > self.ring.max_lag:
+                self.drops += 1
+                self.dropped_bytes += lag
+                self.cursor = head
+                self.write_index()  # the time goes on, the offset does not
+                continue
+            # Copy at most what is left of the segment, so that a copy can be taken back: the event loop goes on writing
+            # the ring meanwhile, and if it has overwritten the data while it was copied, that is a drop too.
+            chunks = self.ring.read(self.cursor, min(RingBuffer.max_read, self.size - self.offset))
+            if not chunks:
+                break
+            cursor, offset = self.cursor, self.offset
+            for chunk in chunks:
+                self.write(chunk)
+            if not self.ring.intact(cursor):
+                self.offset = offset
+                self.recorded_bytes -= self.cursor - cursor
+                self.drops += 1
+                self.dropped_bytes += self.ring.head - cursor
+                self.cursor = self.ring.head
+                self.write_index()
+                continue
+            if self.offset == self.size:
+                self.close_segment()
+                self.start_segment()
+        if (time.time() - self.index_time >= self.config.record_index_interval or self.server.ring_sample_rate != self.index_sample_rate
+                or self.server.dongle_identifier != self.index_identifier):
+            self.write_index()
+        if self.next_segment is None and self.offset > self.size // 2:
+            self.next_segment = self.create_segment()
+
+    def write(self, data):
+        self.segment[2][self.offset:self.offset + len(data)] = data
+        self.offset += len(data)
+        self.cursor += len(data)
+        self.recorded_bytes += len(data)
+
+    def start_segment(self):
+        self.segment = self.next_segment or self.create_segment()
+        self.next_segment = None
+        self.offset = 0
+        self.index_identifier = None
+        self.segments += 1
+        self.write_index()
+        self.rotate()
+
+    def write_index(self):
+        # the data at the cursor has arrived lag bytes ago
+        sample_rate = self.server.ring_sample_rate
+        identifier = self.server.dongle_identifier
+        now = time.time()
+        entry = dict(time=round(now - (self.ring.head - self.cursor) / (2.0 * sample_rate), 6), offset=self.offset, sample_rate=sample_rate)
+        if identifier != self.index_identifier:
+            entry['dongle_identifier'] = identifier.hex()
+        self.segment[3].write(json.dumps(entry) + '\n')
+        self.segment[3].flush()
+        self.index_time = now
+        self.index_sample_rate = sample_rate
+        self.index_identifier = identifier
+
+    def create_segment(self):
+        self.sequence += 1
+        path = os.path.join(self.config.record_path, '%s%06d.iq' % (self.prefix, self.sequence))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, self.size)  # the blocks are there before the data is, so writing it does not wait for them
+            data = mmap.mmap(fd, self.size)
+            index = open(path[:-3] + '.idx', 'w')
+        except OSError:
+            os.close(fd)
+            raise
+        return (path, fd, data, index)
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        path, fd, data, index = self.segment
+        try:
+            self.write_index()  # the last line has the length of the segment
+            data.flush()
+            data.close()
+            os.ftruncate(fd, self.offset)
+        except (OSError, ValueError) as exc:
+            LOGGER.error("%s: recording: cannot finish %s: %s", self.config.name, path, exc)
+        finally:
+            self.segment = None
+            os.close(fd)
+            index.close()
+
+    def remove_segment(self, segment):
+        if segment is None:
+            return
+        path, fd, data, index = segment
+        data.close()
+        os.close(fd)
+        index.close()
+        self.remove_files(path)
+
+    def remove_files(self, path):
+        for name in (path, path[:-3] + '.idx'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def rotate(self):
+        # when a segment is started, before the next one is preallocated: only it and the finished ones count
+        if not self.config.record_segments:
+            return
+        # the segments of this upstream only, not of one whose name starts with the same (e.g. dongle and dongle-2)
+        pattern = re.compile(re.escape(self.config.name) + r'-\d{8}-\d{6}-\d{6,}\.iq$')
+        segments = sorted(os.path.join(self.config.record_path, name) for name in os.listdir(self.config.record_path) if pattern.match(name))
+        for path in segments[:max(0, len(segments) - self.config.record_segments)]:
+            if path != self.segment[0]:
+                self.remove_files(path)
+
+    def metrics(self):
+        return {
+            'recorded_bytes': self.recorded_bytes, 'lag': self.ring.head - self.cursor, 'drops': self.drops,
+            'dropped_bytes': self.dropped_bytes, 'segments': self.segments, 'errors': self.errors,
+            'segment': None if self.segment is None else os.path.basename(self.segment[0]),
+        }
+
+
+class ReplayTransport(asyncio.Transport):
+    '''
+    Plays a segment recorded by Recorder to an RtlTcpConnection, as rtl_tcp would send it: the dongle identifier,
+    then the I/Q data, paced by event loop timers at the sample rate it was recorded with. At the end of the
+    segment it starts over. The commands of the clients go nowhere.
+    '''
+
+    tick = 0.02
+    max_catch_up = 0.25
+
+    def __init__(self, path, protocol, sample_rate):
+        asyncio.Transport.__init__(self)
+        self.protocol = protocol
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # ValueError if empty
+        self.length = len(self.data)
+        self.offsets, self.sample_rates = [0], [sample_rate]
+        identifier = b''
+        index_path = os.path.splitext(path)[0] + '.idx'
+        if os.path.exists(index_path):
+            with open(index_path) as index:
+                entries = [json.loads(line) for line in index if line.strip()]
+            for entry in entries:
+                self.offsets.append(entry['offset'])
+                self.sample_rates.append(entry['sample_rate'])
+                identifier = bytes.fromhex(entry.get('dongle_identifier', '')) or identifier
+            # the rest of an interrupted segment is not data (nothing of one preallocated but never started)
+            self.length = min(self.length, max(self.offsets[1:] or [0]))
+        self.length &= ~1
+        if not self.length:
+            raise ValueError('no I/Q data in ' + path)
+        self.view = memoryview(self.data)[:self.length]
+        self.position = 0
+        self.closing = False
+        protocol.connection_made(self)
+        protocol.data_received(identifier.ljust(12, b'\0') if identifier else b'RTL0' + b'\0' * 8)
+        self.last = LOOP.time()
+        self.due = 0.0
+        self.handle = LOOP.call_later(self.tick, self.play)
+
+    def play(self):
+        now = LOOP.time()
+        sample_rate = self.sample_rates[bisect.bisect_right(self.offsets, self.position) - 1]
+        server = self.protocol.upstream.server
+        if server.sample_rate != sample_rate:
+            server.sample_rate = sample_rate  # the recording has it, whatever the clients set
+        self.due = min(self.due + (now - self.last) * sample_rate, self.max_catch_up * sample_rate)
+        self.last = now
+        samples = int(self.due)
+        self.due -= samples
+        length = 2 * samples
+        while length:
+            end = min(self.position + length, self.length)
+            self.protocol.data_received(self.view[self.position:end])
+            length -= end - self.position
+            self.position = 0 if end == self.length else end
+        self.handle = LOOP.call_later(self.tick, self.play)
+
+    def write(self, data):
+        pass
 
-    # start watchdog thread
-    if CONFIG.watchdog_interval != 0:
-        watchdog_thread_v = thread.start_new_thread(watchdog_thread, ())
+    def is_closing(self):
+        return self.closing
 
-    # start asyncores
-    RTL_TCP = RtlTcpAsyncore(False, multiprocessing.Queue(), dsp_input_queue)
-    SERVER = ServerAsyncore(CONFIG.my_ip, CONFIG.my_listening_port)
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.handle.cancel()
+            LOOP.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class ReplayUpstream(RtlTcp):
+    '''Serves a segment recorded by Recorder (replay_file) to the clients, instead of connecting to rtl_tcp.'''
+
+    async def open_connection(self):
+        try:
+            connection = RtlTcpConnection(self)
+            connection.decoder = None  # recorded as plain I/Q
+            ReplayTransport(self.config.replay_file, connection, self.config.initial_sample_rate)
+        except (OSError, ValueError) as exc:
+            LOGGER.error("%s: cannot replay %s: %s", self.config.name, self.config.replay_file, exc)
+            self.disconnected()
+            return
+        LOGGER.info("%s: replaying %s", self.config.name, self.config.replay_file)
+
+    def queue_commands(self, commands):
+        self.commands.clear()
+
+
+
+# the hot paths timed with profile_timings: name -> (class, method)
+HOT_PATHS = {
+    'upstream_read': (RtlTcpConnection, 'data_received'),  # data from rtl_tcp, up to the ring (and the DSP in the event loop)
+    'multicast_read': (MulticastConnection, 'datagram_received'),
+    'add_data_to_clients': (Server, 'add_data_to_clients'),  # into the ring, the compressed streams and the multicast
+    'client_send': (Client, 'pump'),  # from the ring to the transport of one client
+    'dsp_write': (CommandStage, 'write_block'),  # into the pipe of dsp_command, in its writer thread
+    'dsp_read': (CommandStage, 'forward_block'),  # the output of dsp_command to the next stages, in its reader thread
+    'record': (Recorder, 'record'),  # in the recorder thread
+}
+
+
+# options of the whole process, all the others can be set per upstream too
+GLOBAL_OPTIONS = ('upstreams', 'log_file_path', 'setuid_on_start', 'uid', 'use_ip_access_control', 'order_allow_deny', 'denied_ip_ranges', 'allowed_ip_ranges',
+                  'denied_ip_ranges_file', 'allowed_ip_ranges_file',
+                  'metrics_port', 'metrics_ip', 'clients_memory_budget', 'latency_log_interval', 'use_uvloop',
+                  'profile_timings', 'profile_interval', 'profile_path')
+
+
+class UpstreamConfig(object):
+    '''The configuration of one upstream: its entry in upstreams, and the options of the configuration script for the rest.'''
+
+    def __init__(self, index, options):
+        for option in options:
+            assert option == 'name' or hasattr(CONFIG, option) and option not in GLOBAL_OPTIONS, 'upstream %d: %s is not an option of an upstream' % (index, option)
+        self.__dict__.update(options)
+        self.name = options.get('name', 'upstream%d' % index)
+
+    def __getattr__(self, option):
+        return getattr(CONFIG, option)
+
+
+def new_event_loop():
+    if CONFIG.use_uvloop and uvloop is None:
+        LOGGER.error("use_uvloop is set, but uvloop is not installed. Falling back to the default event loop.")
+    loop = uvloop.new_event_loop() if CONFIG.use_uvloop and uvloop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def main():
+    global SERVERS, LOOP, IP_ACCESS
+
+    setup_logging()
+    LOGGER.info("Server is UP")
 
-    asyncore.loop(0.1)
+    IP_ACCESS = IpAccessControl(CONFIG)
+
+    configs = [UpstreamConfig(index, options) for index, options in enumerate(CONFIG.upstreams or [{}])]
+    for config in configs:
+        assert not config.compressed_listening_port or config.compressed_listening_codec in config.compression_codecs, '%s: Make sure compressed_listening_codec is in compression_codecs' % config.name
+
+    LOOP = new_event_loop()
+    if CONFIG.profile_timings:
+        instrument_hot_paths()
+
+    # fork the sender workers of all the upstreams before any other thread is started
+    # clients_memory_budget is shared equally by the workers, and the main process if it serves clients too
+    processes = sum(config.sender_workers for config in configs) + any(not config.sender_workers for config in configs)
+    memory_budget = CONFIG.clients_memory_budget // processes
+    all_workers = []
+    upstreams = []
+    for config in configs:
+        # the ring is also the history for preroll_seconds, with room for the clients to catch up from it
+        ring_size = max(config.ring_buffer_size, int(2 * config.initial_sample_rate * config.preroll_seconds * 4 / 3) + 2 * RingBuffer.safety_margin)
+        ring = RingBuffer(ring_size, shared=config.sender_workers > 0)
+        streams = dict((frame_codec_id(name), CompressedStream(config, name, config.sender_workers > 0)) for name in config.compression_codecs)
+        workers = []
+        for index in range(config.sender_workers):
+            workers.append(SenderWorker(config, index, ring, streams, all_workers, memory_budget))
+            all_workers.append(workers[-1])
+        upstreams.append((config, ring, streams, workers))
+
+    # start the event loop, one Server, DSP pipeline and rtl_tcp connection per upstream
+    SERVERS = [Server(*upstream) for upstream in upstreams]
+    for server in SERVERS:
+        dsp = start_dsp(server) if server.config.dsp_pipeline or server.config.use_dsp_command else None
+        if dsp is not None:
+            server.decimation = dsp.decimation
+        upstream = ReplayUpstream if server.config.replay_file else MulticastUpstream if server.config.multicast_upstream else RtlTcp
+        server.rtl_tcp = upstream(server, dsp, TunerState(server.config))
+        if server.config.record_path:
+            server.recorder = Recorder(server)
+    if memory_budget and any(not server.workers for server in SERVERS):
+        LOOP.call_later(memory_check_interval, enforce_memory_budget, memory_budget)
+    METRICS.start()
+    LOOP.add_signal_handler(signal.SIGHUP, reload_ip_access_control)
+    LOOP.add_signal_handler(signal.SIGUSR1, toggle_profiler)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        LOOP.add_signal_handler(signum, LOOP.stop)
+    if CONFIG.metrics_port:
+        LOOP.run_until_complete(asyncio.start_server(handle_metrics_request, CONFIG.metrics_ip, CONFIG.metrics_port))
+        LOGGER.info("Metrics listening on port: %s", CONFIG.metrics_port)
+
+    LOOP.run_forever()
+    for server in SERVERS:
+        if server.recorder is not None:
+            server.recorder.close()
+    LOGGER.info("Server is DOWN")
 
 
 if __name__ == "__main__":